@@ -1,9 +1,54 @@
 # Copyright (c) 2025, Centura AG and Contributors
 # See license.txt
 
-# import frappe
+import functools
+import json
+import os
+import re
+import tempfile
+import zipfile
+from unittest.mock import patch
+
+import frappe
 from frappe.tests import IntegrationTestCase, UnitTestCase
 
+from camt_import.camt_import.doctype.transaction_matching_tool.transaction_matching_tool import (
+	AUTO_RECONCILE_CACHE_EXPIRY,
+	MATCH_SPECS,
+	CamtImportError,
+	_import_camt_job,
+	_reconcile_chunk,
+	auto_reconcile_vouchers,
+	build_invoice_matching_query,
+	collect_auto_reconcile_result,
+	get_allocatable_doctypes,
+	get_auto_reconcile_key,
+	get_auto_reconcile_lock_key,
+	get_je_matching_query,
+	get_je_matching_sql,
+	get_ld_matching_query,
+	get_lr_matching_query,
+	get_matchable_reference_numbers,
+	get_matching_queries,
+	get_pe_matching_query,
+	get_pe_matching_sql,
+	import_camt,
+	insert_bank_transactions,
+	is_xml_member,
+	iter_bank_transaction_names,
+	iter_chunks,
+	iter_entries,
+	iter_xml_rows,
+	normalize_reference,
+	notify_auto_reconcile_result,
+	sniff_namespace,
+	subtract_allocations,
+)
+from camt_import.camt_import.doctype.transaction_matching_tool.utils import (
+	get_description_match_condition,
+	is_reference_provided,
+)
+
 
 # On IntegrationTestCase, the doctype test records and all
 # link-field test record dependencies are recursively loaded
@@ -11,6 +56,81 @@ from frappe.tests import IntegrationTestCase, UnitTestCase
 EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
 
+TOOL_MODULE = "camt_import.camt_import.doctype.transaction_matching_tool.transaction_matching_tool"
+
+CAMT_NAMESPACE = "urn:iso:std:iso:20022:tech:xsd:camt.053.001.08"
+CAMT_DOCUMENT = f"""<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="{CAMT_NAMESPACE}"><BkToCstmrStmt><Stmt>
+<Ntry>
+	<Amt Ccy="CHF">12.30</Amt><CdtDbtInd>CRDT</CdtDbtInd><BookgDt><Dt>2025-02-01</Dt></BookgDt>
+	<NtryDtls><TxDtls>
+		<Refs><AcctSvcrRef>INNER</AcctSvcrRef></Refs>
+		<RmtInf><Strd><CdtrRefInf><Ref>RF18 5390</Ref></CdtrRefInf></Strd></RmtInf>
+	</TxDtls></NtryDtls>
+	<AddtlNtryInf>Gutschrift, "Muster" AG</AddtlNtryInf>
+</Ntry>
+<Ntry>
+	<Amt Ccy="CHF">5.00</Amt><CdtDbtInd>DBIT</CdtDbtInd><BookgDt><Dt>2025-02-02</Dt></BookgDt>
+	<AcctSvcrRef>OUTER</AcctSvcrRef>
+</Ntry>
+</Stmt></BkToCstmrStmt></Document>
+"""
+CAMT_ROWS = [
+	("2025-02-01", "12.30", 0, "RF18 5390", 'Gutschrift, "Muster" AG'),
+	("2025-02-02", 0, "5.00", "OUTER", ""),
+]
+
+
+class FakeCache:
+	"""In-memory stand-in for the redis calls of the auto reconciliation."""
+
+	def __init__(self):
+		self.data = {}
+		self.expiry = {}
+
+	def make_key(self, key):
+		return f"test|{key}"
+
+	def set(self, key, value, ex=None, nx=False):
+		if nx and key in self.data:
+			return None
+		self.data[key] = value
+		return True
+
+	def get(self, key):
+		return self.data.get(key)
+
+	def incr(self, key):
+		self.data[key] = self.data.get(key, 0) + 1
+		return self.data[key]
+
+	def decr(self, key):
+		self.data[key] = self.data.get(key, 0) - 1
+		return self.data[key]
+
+	def expire(self, key, time):
+		self.expiry[key] = time
+
+	def rpush(self, key, value):
+		self.data.setdefault(self.make_key(key), []).append(value)
+
+	def lpop(self, key):
+		values = self.data.get(self.make_key(key))
+		value = values.pop(0) if values else None
+		if values == []:
+			del self.data[self.make_key(key)]
+		return value
+
+	def sadd(self, key, *values):
+		self.data.setdefault(self.make_key(key), set()).update(values)
+
+	def smembers(self, key):
+		return self.data.get(self.make_key(key), set())
+
+	def delete(self, *keys):
+		for key in keys:
+			self.data.pop(key, None)
+
 
 class UnitTestTransactionMatchingTool(UnitTestCase):
 	"""
@@ -18,7 +138,617 @@ class UnitTestTransactionMatchingTool(UnitTestCase):
 	Use this class for testing individual functions and methods.
 	"""
 
-	pass
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tempdir.cleanup)
+
+	def write_file(self, name, content):
+		path = os.path.join(self.tempdir.name, name)
+		with open(path, "w", encoding="utf-8") as file:
+			file.write(content)
+		return path
+
+	def write_zip(self, name, members):
+		path = os.path.join(self.tempdir.name, name)
+		with zipfile.ZipFile(path, "w") as zip_ref:
+			for member_name, content in members.items():
+				zip_ref.writestr(member_name, content)
+		return path
+
+	def get_sql(self, query):
+		# Independent of the identifier quotes of the database
+		return query.get_sql().replace("`", "").replace('"', "")
+
+	def get_condition_sql(self, description, column_name):
+		payment_entry = frappe.qb.DocType("Payment Entry")
+		condition = get_description_match_condition(description, payment_entry, column_name)
+		return self.get_sql(frappe.qb.from_(payment_entry).select(condition))
+
+	def test_iter_entries_releases_entries(self):
+		xml_path = self.write_file("statement.xml", CAMT_DOCUMENT)
+		booking_dates = []
+		ns = f"{{{CAMT_NAMESPACE}}}"
+		for entry in iter_entries(xml_path):
+			# Only the entry before is still in the tree, and it has been cleared
+			previous = entry.getprevious()
+			self.assertTrue(previous is None or len(previous) == 0)
+			self.assertLessEqual(len(entry.getparent()), 2)
+			booking_dates.append(entry.findtext(f"{ns}BookgDt/{ns}Dt"))
+
+		self.assertEqual(booking_dates, ["2025-02-01", "2025-02-02"])
+
+	def test_parse_xml_rows(self):
+		xml_path = self.write_file("statement.xml", CAMT_DOCUMENT)
+		self.assertEqual(list(iter_xml_rows([xml_path])), CAMT_ROWS)
+
+	def test_parse_zip_members_in_order(self):
+		zip_path = self.write_zip(
+			"statements.zip", {"a.xml": CAMT_DOCUMENT, "b.xml": CAMT_DOCUMENT}
+		)
+		xml_files = [(zip_path, "a.xml"), (zip_path, "b.xml"), self.write_file("c.xml", CAMT_DOCUMENT)]
+		self.assertEqual(list(iter_xml_rows(xml_files)), CAMT_ROWS * 3)
+
+	def test_sniff_namespace(self):
+		xml_path = self.write_file("statement.xml", CAMT_DOCUMENT)
+		self.assertEqual(sniff_namespace(xml_path), CAMT_NAMESPACE)
+
+		# Prefixed declarations are found as well, other namespaces are not
+		prefixed = CAMT_DOCUMENT.replace('xmlns="', 'xmlns:x="urn:other" xmlns:camt="')
+		self.assertEqual(sniff_namespace(self.write_file("prefixed.xml", prefixed)), CAMT_NAMESPACE)
+		self.assertEqual(sniff_namespace(self.write_file("other.xml", "<Document/>")), "")
+
+		# ZIP members are peeked at without consuming the stream
+		zip_path = self.write_zip("statements.zip", {"a.xml": CAMT_DOCUMENT})
+		with zipfile.ZipFile(zip_path) as zip_ref, zip_ref.open("a.xml") as member:
+			self.assertEqual(sniff_namespace(member), CAMT_NAMESPACE)
+			self.assertEqual(member.read(), CAMT_DOCUMENT.encode())
+
+	def test_is_xml_member(self):
+		zip_path = self.write_zip(
+			"statements.zip",
+			{
+				"statement.XML": "",
+				"statements/february.xml": "",
+				"statements/": "",
+				"readme.txt": "",
+				"../escape.xml": "",
+				"/absolute.xml": "",
+				"__MACOSX/._statement.xml": "",
+			},
+		)
+		with zipfile.ZipFile(zip_path) as zip_ref:
+			members = [info.filename for info in zip_ref.infolist() if is_xml_member(info)]
+
+		self.assertEqual(members, ["statement.XML", "statements/february.xml"])
+
+	def test_auto_reconcile_vouchers_enqueues_chunks(self):
+		names = [f"ACC-BTN-2025-{i:05d}" for i in range(120)]
+		cache = FakeCache()
+		with (
+			patch("frappe.has_permission"),
+			patch(f"{TOOL_MODULE}.iter_bank_transaction_names", return_value=iter(names)),
+			patch("frappe.cache", return_value=cache),
+			patch("frappe.enqueue") as enqueue,
+		):
+			batch_id = auto_reconcile_vouchers("Bank - MA")
+
+		# Only the first chunk is enqueued, the others wait for it
+		enqueue.assert_called_once()
+		job = enqueue.call_args.kwargs
+		self.assertEqual(job["transaction_names"], names[:50])
+		self.assertEqual((job["batch_id"], job["queue"]), (batch_id, "long"))
+		chunks_key = cache.make_key(get_auto_reconcile_key(batch_id, "chunks"))
+		self.assertEqual([json.loads(chunk) for chunk in cache.data[chunks_key]], [names[50:100], names[100:]])
+		self.assertIn(chunks_key, cache.expiry)
+		self.assertEqual(cache.data[cache.make_key(get_auto_reconcile_lock_key("Bank - MA"))], batch_id)
+
+	def test_auto_reconcile_vouchers_runs_once_per_bank_account(self):
+		cache = FakeCache()
+		cache.set(cache.make_key(get_auto_reconcile_lock_key("Bank - MA")), "other batch")
+		with (
+			patch("frappe.has_permission"),
+			patch("frappe.cache", return_value=cache),
+			patch("frappe.enqueue") as enqueue,
+		):
+			self.assertRaises(frappe.ValidationError, auto_reconcile_vouchers, "Bank - MA")
+
+		enqueue.assert_not_called()
+
+	def test_iter_bank_transaction_names(self):
+		pages = [["BT-1", "BT-2"], ["BT-3", "BT-4"], ["BT-5"]]
+		with patch("frappe.get_list", side_effect=pages) as get_list:
+			names = list(iter_bank_transaction_names("Bank - MA", page_length=2))
+
+		self.assertEqual(names, ["BT-1", "BT-2", "BT-3", "BT-4", "BT-5"])
+		self.assertEqual([call.kwargs["limit_start"] for call in get_list.call_args_list], [0, 2, 4])
+
+	def test_iter_chunks(self):
+		self.assertEqual(list(iter_chunks(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+		self.assertEqual(list(iter_chunks([], 2)), [])
+
+	def test_auto_reconcile_vouchers_without_transactions(self):
+		cache = FakeCache()
+		with (
+			patch("frappe.has_permission"),
+			patch(f"{TOOL_MODULE}.iter_bank_transaction_names", return_value=iter([])),
+			patch("frappe.cache", return_value=cache),
+			patch("frappe.enqueue") as enqueue,
+			patch(f"{TOOL_MODULE}.notify_auto_reconcile_result") as notify,
+		):
+			self.assertIsNone(auto_reconcile_vouchers("Bank - MA"))
+
+		enqueue.assert_not_called()
+		notify.assert_called_once_with(set(), set())
+		# The bank account is not locked
+		self.assertEqual(cache.data, {})
+
+	def test_last_chunk_reports_auto_reconcile_result(self):
+		cache = FakeCache()
+		cache.set(cache.make_key(get_auto_reconcile_lock_key("Bank - MA")), "batch")
+		cache.rpush(get_auto_reconcile_key("batch", "chunks"), json.dumps(["BT-2", "BT-3", "BT-4"]))
+		with (
+			patch("frappe.cache", return_value=cache),
+			patch(f"{TOOL_MODULE}.notify_auto_reconcile_result") as notify,
+			patch("frappe.publish_realtime") as publish_realtime,
+		):
+			next_chunk = collect_auto_reconcile_result("batch", "Bank - MA", {"BT-1"}, set(), set(), True)
+			self.assertEqual(next_chunk, ["BT-2", "BT-3", "BT-4"])
+			# Every key of the batch expires, even if the batch never finishes
+			for name in ("reconciled", "failed_chunks"):
+				self.assertEqual(
+					cache.expiry[cache.make_key(get_auto_reconcile_key("batch", name))],
+					AUTO_RECONCILE_CACHE_EXPIRY,
+				)
+			notify.assert_not_called()
+			publish_realtime.assert_not_called()
+			self.assertIsNone(
+				collect_auto_reconcile_result("batch", "Bank - MA", {"BT-2"}, {"BT-3"}, {"BT-4"})
+			)
+
+		notify.assert_called_once_with(
+			{"BT-1", "BT-2"}, {"BT-3"}, failed={"BT-4"}, failed_chunks=1, realtime=True
+		)
+		publish_realtime.assert_called_once_with(
+			"auto_reconcile_complete", {"bank_account": "Bank - MA"}, user=frappe.session.user
+		)
+		# All keys of the batch are removed and the bank account is unlocked
+		self.assertEqual(cache.data, {})
+
+	def test_reconcile_chunk_skips_unmatchable_references(self):
+		transactions = [
+			frappe._dict(name="BT-1", unallocated_amount=100.0, reference_number="r1 "),
+			frappe._dict(name="BT-2", unallocated_amount=50.0, reference_number="R2"),
+		]
+		with (
+			patch("frappe.get_all", return_value=transactions),
+			patch("frappe.db.get_value", return_value=("1020 - Bank - MA", "_Test Company")),
+			patch("frappe.db.savepoint"),
+			patch("frappe.db.commit"),
+			patch("frappe.get_doc") as get_doc,
+			patch(f"{TOOL_MODULE}.get_account_currency", return_value="CHF"),
+			patch(f"{TOOL_MODULE}.has_external_matching_queries", return_value=False),
+			patch(f"{TOOL_MODULE}.get_matchable_reference_numbers", return_value={"r1"}) as prefilter,
+			patch(f"{TOOL_MODULE}.get_transaction_matches", return_value=[]) as get_transaction_matches,
+			patch(f"{TOOL_MODULE}.collect_auto_reconcile_result", return_value=None) as collect,
+		):
+			_reconcile_chunk("batch", "Bank - MA", ["BT-1", "BT-2"])
+
+		prefilter.assert_called_once_with("1020 - Bank - MA", {"r1 ", "R2"})
+		# Only the transaction with a matchable reference is loaded and matched
+		get_doc.assert_called_once_with("Bank Transaction", "BT-1")
+		self.assertEqual(get_transaction_matches.call_count, 1)
+		self.assertEqual(get_transaction_matches.call_args.args[2:5], ("1020 - Bank - MA", "_Test Company", "CHF"))
+		collect.assert_called_once_with("batch", "Bank - MA", set(), set(), set(), False)
+		self.assertFalse(frappe.flags.auto_reconcile_vouchers)
+
+	def test_reconcile_chunk_rolls_back_failed_transactions(self):
+		transactions = [
+			frappe._dict(name="BT-1", unallocated_amount=100.0, reference_number="R1"),
+			frappe._dict(name="BT-2", unallocated_amount=50.0, reference_number="R2"),
+		]
+		with (
+			patch("frappe.get_all", return_value=transactions),
+			patch("frappe.db.get_value", return_value=("1020 - Bank - MA", "_Test Company")),
+			patch("frappe.db.savepoint") as savepoint,
+			patch("frappe.db.rollback") as rollback,
+			patch("frappe.db.commit") as commit,
+			patch("frappe.log_error") as log_error,
+			patch(f"{TOOL_MODULE}.get_account_currency", return_value="CHF"),
+			patch(f"{TOOL_MODULE}.has_external_matching_queries", return_value=True),
+			patch(
+				f"{TOOL_MODULE}.auto_reconcile_transaction", side_effect=[ValueError, "Reconciled"]
+			),
+			patch(f"{TOOL_MODULE}.collect_auto_reconcile_result", return_value=["BT-3"]) as collect,
+			patch("frappe.enqueue") as enqueue,
+		):
+			_reconcile_chunk("batch", "Bank - MA", ["BT-1", "BT-2"])
+
+		self.assertEqual(savepoint.call_count, 2)
+		rollback.assert_called_once_with(save_point=savepoint.call_args.args[0])
+		log_error.assert_called_once()
+		commit.assert_called_once()
+		collect.assert_called_once_with("batch", "Bank - MA", {"BT-2"}, set(), {"BT-1"}, False)
+		# The next chunk starts once this one is done
+		enqueue.assert_called_once()
+		self.assertEqual(enqueue.call_args.kwargs["transaction_names"], ["BT-3"])
+		self.assertFalse(enqueue.call_args.kwargs["enqueue_after_commit"])
+
+	def test_reconcile_chunk_reports_failed_chunk(self):
+		transactions = [frappe._dict(name="BT-1", unallocated_amount=100.0, reference_number="R1")]
+		with (
+			patch("frappe.get_all", return_value=transactions),
+			patch("frappe.db.get_value", return_value=("1020 - Bank - MA", "_Test Company")),
+			patch("frappe.db.savepoint"),
+			patch("frappe.db.commit", side_effect=RuntimeError),
+			patch("frappe.db.rollback") as rollback,
+			patch(f"{TOOL_MODULE}.get_account_currency", return_value="CHF"),
+			patch(f"{TOOL_MODULE}.has_external_matching_queries", return_value=True),
+			patch(f"{TOOL_MODULE}.auto_reconcile_transaction", return_value="Reconciled"),
+			patch(f"{TOOL_MODULE}.collect_auto_reconcile_result", return_value=None) as collect,
+		):
+			self.assertRaises(RuntimeError, _reconcile_chunk, "batch", "Bank - MA", ["BT-1"])
+
+		# Only names whose work was committed are reported as reconciled
+		rollback.assert_called_once_with()
+		collect.assert_called_once_with("batch", "Bank - MA", set(), set(), set(), True)
+
+	def test_matchable_reference_numbers_without_references(self):
+		with patch("frappe.qb.from_") as from_:
+			self.assertEqual(get_matchable_reference_numbers("1020 - Bank - MA", {"", None}), set())
+
+		from_.assert_not_called()
+
+	def test_normalize_reference(self):
+		self.assertEqual(normalize_reference(" RF18 5390 "), "rf18 5390")
+		self.assertEqual(normalize_reference(None), "")
+
+	def test_subtract_allocations(self):
+		vouchers = [
+			frappe._dict(doctype="Payment Entry", name="PE-1", paid_amount=300.0),
+			frappe._dict(doctype="Journal Entry", name="JE-1", paid_amount=50.0),
+			frappe._dict(doctype="Payment Entry", name="PE-2", paid_amount=80.0),
+		]
+		allocations = {
+			("Payment Entry", "PE-1"): [
+				{"total": 100.0, "gl_account": "1020 - Bank - MA"},
+				# Allocations on another bank account are ignored
+				{"total": 30.0, "gl_account": "1021 - Bank 2 - MA"},
+			],
+			("Journal Entry", "JE-1"): [
+				{"total": 20.0, "gl_account": "1020 - Bank - MA"},
+				{"total": 5.0, "gl_account": "1020 - Bank - MA"},
+			],
+		}
+		with (
+			patch("frappe.get_hooks", return_value=["Payment Entry", "Journal Entry"]),
+			patch(f"{TOOL_MODULE}.get_total_allocated_amount", return_value=allocations) as get_total,
+		):
+			subtract_allocations("1020 - Bank - MA", vouchers)
+
+		get_total.assert_called_once_with(
+			[("Payment Entry", "PE-1"), ("Journal Entry", "JE-1"), ("Payment Entry", "PE-2")]
+		)
+		self.assertEqual([voucher.paid_amount for voucher in vouchers], [200.0, 25.0, 80.0])
+
+	def test_get_allocatable_doctypes(self):
+		hooks = ["Payment Entry", "Journal Entry", "Sales Invoice", "Purchase Invoice", "Loan Disbursement"]
+		with patch("frappe.get_hooks", return_value=hooks) as get_hooks:
+			self.assertEqual(get_allocatable_doctypes(["payment_entry"]), set(hooks))
+			# Invoices are only matched as unpaid invoices, which are never allocated
+			self.assertEqual(
+				get_allocatable_doctypes(["unpaid_invoices"]),
+				{"Payment Entry", "Journal Entry", "Loan Disbursement"},
+			)
+
+		get_hooks.assert_called_with("bank_reconciliation_doctypes")
+
+	def test_loan_matching_queries(self):
+		common_filters = frappe._dict(
+			amount=100.0,
+			party_type="Customer",
+			party="_Test Customer",
+			bank_account="1020 - Bank - MA",
+			date="2025-02-01",
+			description="",
+			reference_no="R1",
+		)
+		with patch("frappe.db.has_column", return_value=False):
+			queries = {
+				"disbursed_amount": (get_ld_matching_query, "Loan Disbursement"),
+				"amount_paid": (get_lr_matching_query, "Loan Repayment"),
+			}
+			for amount_column, (get_query, doctype) in queries.items():
+				exact_sql = self.get_sql(get_query(True, common_filters))
+				sql = self.get_sql(get_query(False, common_filters))
+
+				self.assertIn(f"FROM tab{doctype}", sql)
+				# The party only ranks if both the applicant type and the applicant match
+				self.assertIn(
+					"CASE WHEN applicant_type='Customer' AND applicant='_Test Customer' THEN 1 ELSE 0 END party_match",
+					sql,
+				)
+				self.assertIn(f"{amount_column}=100.0", exact_sql)
+				self.assertIn(f"{amount_column}>0.0", sql)
+
+	def test_is_reference_provided(self):
+		self.assertTrue(is_reference_provided("RF18 5390"))
+		self.assertFalse(is_reference_provided(""))
+		self.assertFalse(is_reference_provided(None))
+		self.assertFalse(is_reference_provided("NOTPROVIDED"))
+
+	def test_name_in_description(self):
+		sql = self.get_condition_sql("Payment ACC-PAY-2025-00012", "name")
+		self.assertIn("INSTR(CAST('Payment ACC-PAY-2025-00012' AS BINARY),REGEXP_REPLACE(name,'^[^0-9]*',''))>0", sql)
+
+		# Without a digit in the description no name can match
+		self.assertNotIn("INSTR", self.get_condition_sql("Payment", "name"))
+		self.assertIn("INSTR", self.get_condition_sql("Payment", "reference_no"))
+
+	def test_reference_in_description_is_trimmed(self):
+		sql = self.get_condition_sql("Payment RF18 5390", "reference_no")
+		self.assertIn("TRIM(reference_no)<>''", sql)
+		self.assertIn("INSTR(CAST('Payment RF18 5390' AS BINARY),TRIM(reference_no))>0", sql)
+
+	def test_reference_in_description_is_case_sensitive(self):
+		# Compared as binary, not with the case-insensitive collation of the column
+		sql = self.get_condition_sql("payment rf18 5390", "reference_no")
+		self.assertIn("INSTR(CAST('payment rf18 5390' AS BINARY),", sql)
+
+	def test_matching_sql_is_cached_per_query_shape(self):
+		get_pe_matching_sql.cache_clear()
+		get_je_matching_sql.cache_clear()
+		common_filters = frappe._dict(
+			amount=100.0,
+			payment_type="Receive",
+			reference_no="RF18 5390",
+			party="_Test Customer",
+			party_type="Customer",
+			bank_account="1020 - Bank - MA",
+			date="2025-02-01",
+			description="Payment RF18 5390",
+		)
+		other_filters = frappe._dict(common_filters, amount=5.0, reference_no="R2", date="2025-02-02")
+
+		for get_query, args in (
+			(get_pe_matching_query, ("paid_to", "2025-01-01", "2025-02-28")),
+			(get_je_matching_query, ("2025-01-01", "2025-02-28")),
+		):
+			query = get_query(False, common_filters, *args)
+			other_query = get_query(False, other_filters, *args)
+
+			# Same shape, same SQL string: only the bound values differ
+			self.assertIs(query.sql, other_query.sql)
+			self.assertEqual((query.values["amount"], other_query.values["amount"]), (100.0, 5.0))
+			# Every parameter of the SQL is bound
+			self.assertLessEqual(set(re.findall(r"%\((\w+)\)s", query.sql)), set(query.values))
+
+		self.assertEqual(get_pe_matching_sql.cache_info().misses, 1)
+		self.assertEqual(get_je_matching_sql.cache_info().misses, 1)
+
+		# A different shape is built separately
+		get_pe_matching_query(True, frappe._dict(common_filters, reference_no=""), "paid_to")
+		self.assertEqual(get_pe_matching_sql.cache_info().misses, 2)
+
+	def test_unpaid_invoice_query(self):
+		common_filters = frappe._dict(
+			amount=100.0, party="_Test Customer", date="2025-02-01", description="", reference_no=""
+		)
+		query = functools.partial(
+			build_invoice_matching_query,
+			MATCH_SPECS[("sales_invoice", "unpaid")],
+			exact_match=False,
+			currency="CHF",
+			common_filters=common_filters,
+			company="_Test Company",
+			include_only_returns=True,
+		)
+		sql = self.get_sql(query())
+		with patch.dict(frappe.flags, {"auto_reconcile_vouchers": True}):
+			auto_reconcile_sql = self.get_sql(query())
+
+		self.assertIn("FROM tabSales Invoice", sql)
+		self.assertIn("outstanding_amount<>0.0", sql)
+		self.assertIn("company='_Test Company'", sql)
+		self.assertIn("currency='CHF'", sql)
+		self.assertIn("is_return=1", sql)
+		self.assertIn("customer_name party_name", sql)
+		# The interactive list shows every candidate, auto reconciliation skips
+		# the rows without any matching signal
+		signals = "(outstanding_amount=100.0 OR customer='_Test Customer')"
+		self.assertNotIn(signals, sql)
+		self.assertIn(signals, auto_reconcile_sql)
+		# Ordered by the selected rank instead of repeating its expression
+		self.assertIn("ORDER BY rank DESC", sql)
+
+	def test_paid_invoice_query_exact_match(self):
+		common_filters = frappe._dict(
+			amount=100.0, party=None, bank_account="Bank - MA", date="2025-02-01", description="", reference_no=""
+		)
+		sql = self.get_sql(
+			build_invoice_matching_query(
+				MATCH_SPECS[("purchase_invoice", "paid")],
+				exact_match=True,
+				currency="CHF",
+				common_filters=common_filters,
+			)
+		)
+
+		self.assertIn("is_paid=1", sql)
+		self.assertIn("cash_bank_account='Bank - MA'", sql)
+		self.assertIn("paid_amount<>0.0", sql)
+		self.assertIn("paid_amount=100.0", sql)
+		self.assertIn("clearance_date IS NULL", sql)
+		# The reference defaults to the supplier's bill number
+		self.assertIn("bill_no reference_no", sql)
+		# The exact amount is a signal of every row: no prefilter
+		self.assertNotIn(" OR ", sql)
+
+	def test_unpaid_invoice_queries_are_combined(self):
+		transaction = frappe._dict(name="BT-1", deposit=0.0, withdrawal=100.0, description="")
+		common_filters = frappe._dict(
+			amount=100.0,
+			currency="CHF",
+			party="_Test Supplier",
+			party_type="Supplier",
+			bank_account="Bank - MA",
+			date="2025-02-01",
+			reference_no="",
+		)
+		document_types = ["sales_invoice", "purchase_invoice", "expense_claim", "unpaid_invoices"]
+		with (
+			patch("frappe.has_permission"),
+			patch(f"{TOOL_MODULE}.get_company_currency", return_value="CHF"),
+		):
+			queries = get_matching_queries(
+				"Bank - MA", "_Test Company", transaction, document_types, common_filters=common_filters
+			)
+
+		# One statement for all invoice doctypes, each part with its own order and limit
+		self.assertEqual(len(queries), 1)
+		sql = self.get_sql(queries[0])
+		self.assertEqual(sql.count(" UNION ALL "), 2)
+		self.assertEqual(sql.count(" LIMIT "), 3)
+		parts = ["FROM tabPurchase Invoice", "FROM tabExpense Claim", "FROM tabSales Invoice"]
+		self.assertEqual(sorted(parts, key=sql.find), parts)
+		# All parts select the same columns
+		self.assertEqual(sql.count(" party_name,"), 3)
+		self.assertEqual(sql.count(" date_match FROM "), 3)
+
+	def test_import_camt_passes_absolute_paths(self):
+		with (
+			patch("frappe.utils.get_site_path", return_value="./test_site"),
+			patch(f"{TOOL_MODULE}.extract_xml_files", return_value=["statement.xml"]) as extract,
+			patch("frappe.enqueue") as enqueue,
+		):
+			import_camt("/private/files/statement.xml", "_Test Company", "Bank - MA")
+
+		# get_site_path() is relative, the job gets an absolute path
+		site_path = extract.call_args.args[1]
+		self.assertTrue(os.path.isabs(site_path))
+		self.assertEqual(site_path, os.path.abspath("./test_site"))
+		self.assertEqual(enqueue.call_args.kwargs["xml_file_list"], ["statement.xml"])
+
+	def test_import_camt_job(self):
+		xml_files = ["/tmp/statement.xml"]
+		with (
+			patch(f"{TOOL_MODULE}.insert_bank_transactions", return_value=(2, [])) as insert,
+			patch("frappe.db.commit") as commit,
+			patch("frappe.msgprint") as msgprint,
+			patch("frappe.publish_realtime") as publish_realtime,
+		):
+			_import_camt_job(xml_files, "_Test Company", "Bank - MA")
+
+		insert.assert_called_once_with(xml_files, "_Test Company", "Bank - MA")
+		commit.assert_called_once()
+		msgprint.assert_called_once_with(
+			"2 Bank Transactions imported", title="CAMT Import Complete", indicator="green", realtime=True
+		)
+		# Lets the open form reload its bank transactions
+		publish_realtime.assert_called_once_with(
+			"camt_import_complete", {"bank_account": "Bank - MA"}, user=frappe.session.user
+		)
+
+	def test_import_camt_job_reports_skipped_entries(self):
+		skipped = [("2025-02-02", "<OUTER>", "Duplicate entry")]
+		with (
+			patch(f"{TOOL_MODULE}.insert_bank_transactions", return_value=(1, skipped)),
+			patch("frappe.db.commit") as commit,
+			patch("frappe.msgprint") as msgprint,
+			patch("frappe.publish_realtime"),
+		):
+			_import_camt_job(["/tmp/statement.xml"], "_Test Company", "Bank - MA")
+
+		# The inserted entries are kept
+		commit.assert_called_once()
+		self.assertEqual(
+			msgprint.call_args.args[0],
+			"1 Bank Transactions imported<br>1 entries were skipped:"
+			"<ul><li><strong>2025-02-02</strong> &lt;OUTER&gt;: Duplicate entry</li></ul>",
+		)
+		self.assertEqual(msgprint.call_args.kwargs["indicator"], "orange")
+
+	def test_insert_bank_transactions_skips_bad_entries(self):
+		documents = []
+
+		def get_doc(values):
+			documents.append(values)
+			doc = frappe._dict(values)
+			if values["reference_number"] == "OUTER":
+				doc.submit = lambda: frappe.throw("Duplicate entry")
+			else:
+				doc.submit = lambda: None
+			return doc
+
+		with (
+			patch("frappe.db.get_value", return_value="1020 - Bank - MA"),
+			patch(f"{TOOL_MODULE}.get_account_currency", return_value="CHF"),
+			patch(f"{TOOL_MODULE}.iter_xml_rows", return_value=iter(CAMT_ROWS)),
+			patch("frappe.get_doc", side_effect=get_doc),
+			patch("frappe.db.savepoint") as savepoint,
+			patch("frappe.db.rollback") as rollback,
+		):
+			count, skipped = insert_bank_transactions(["/tmp/statement.xml"], "_Test Company", "Bank - MA")
+
+		self.assertEqual(count, 1)
+		self.assertEqual(skipped, [("2025-02-02", "OUTER", "Duplicate entry")])
+		self.assertEqual(savepoint.call_count, 2)
+		rollback.assert_called_once_with(save_point=savepoint.call_args.args[0])
+		self.assertEqual(
+			(documents[0]["deposit"], documents[0]["withdrawal"], documents[0]["currency"]),
+			(12.3, 0.0, "CHF"),
+		)
+		# The amounts from the file are converted, not passed on as strings
+		self.assertIsInstance(documents[1]["withdrawal"], float)
+
+	def test_import_camt_job_error(self):
+		with (
+			patch(f"{TOOL_MODULE}.insert_bank_transactions", side_effect=ValueError("Invalid date")),
+			patch("frappe.db.commit") as commit,
+			patch("frappe.log_error") as log_error,
+			patch("frappe.msgprint") as msgprint,
+			patch("frappe.publish_realtime") as publish_realtime,
+		):
+			with self.assertRaises(CamtImportError):
+				_import_camt_job(["/tmp/statement.xml"], "_Test Company", "Bank - MA")
+
+		# Nothing is committed, and the user is told why
+		commit.assert_not_called()
+		# The job runner logs the failed job
+		log_error.assert_not_called()
+		publish_realtime.assert_not_called()
+		self.assertEqual(msgprint.call_args.args, ("Error importing CAMT file: Invalid date",))
+		self.assertEqual(msgprint.call_args.kwargs["indicator"], "red")
+
+	def test_notify_auto_reconcile_result(self):
+		with patch("frappe.msgprint") as msgprint:
+			notify_auto_reconcile_result({"BT-1", "BT-2"}, {"BT-3"}, realtime=True)
+			notify_auto_reconcile_result(set(), set())
+
+		result, no_matches = (call.kwargs for call in msgprint.call_args_list)
+		self.assertEqual(
+			result["msg"],
+			"2 Transactions <strong>Reconciled</strong><br>1 Transaction <strong>Partially Reconciled</strong>",
+		)
+		self.assertEqual((result["indicator"], result["realtime"]), ("green", True))
+		self.assertEqual(no_matches["msg"], "No matches occurred via Auto Reconciliation")
+		self.assertEqual((no_matches["indicator"], no_matches["realtime"]), ("blue", False))
+
+	def test_notify_auto_reconcile_failures(self):
+		with patch("frappe.msgprint") as msgprint:
+			notify_auto_reconcile_result({"BT-1"}, set(), failed={"BT-2", "BT-3"})
+			notify_auto_reconcile_result(set(), set(), failed_chunks=1)
+
+		failed, failed_chunk = (call.kwargs for call in msgprint.call_args_list)
+		self.assertEqual(
+			failed["msg"],
+			"1 Transaction <strong>Reconciled</strong><br>2 Transactions <strong>Failed</strong>",
+		)
+		self.assertEqual(failed["indicator"], "orange")
+		self.assertEqual(
+			failed_chunk["msg"],
+			"No matches occurred via Auto Reconciliation<br>1 Batch failed, see the Error Log",
+		)
+		self.assertEqual(failed_chunk["indicator"], "red")
 
 
 class IntegrationTestTransactionMatchingTool(IntegrationTestCase):
@@ -17,6 +17,18 @@ frappe.ui.form.on('Transaction Matching Tool', {
         }
       };
     });
+
+    frappe.realtime.on('camt_import_complete', (data) => {
+      if (data.bank_account === frm.doc.bank_account) {
+        frm.events.get_bank_transactions(frm);
+      }
+    });
+
+    frappe.realtime.on('auto_reconcile_complete', (data) => {
+      if (data.bank_account === frm.doc.bank_account) {
+        frm.refresh();
+      }
+    });
   },
 
   onload: function (frm) {
@@ -85,8 +97,12 @@ frappe.ui.form.on('Transaction Matching Tool', {
             },
             callback: function (r) {
               if (!r.exc) {
-                frappe.msgprint(__('CAMT File Import started'));
-                frm.refresh();
+                frappe.show_alert({
+                  message: __(
+                    'CAMT File Import queued. You will be notified once it is complete.'
+                  ),
+                  indicator: 'blue'
+                });
               }
             },
             error: function (r) {
@@ -121,8 +137,13 @@ frappe.ui.form.on('Transaction Matching Tool', {
             freeze: true,
             freeze_message: __('Auto Reconciling ...'),
             callback: (r) => {
-              if (!r.exc) {
-                frm.refresh();
+              if (!r.exc && r.message) {
+                frappe.show_alert({
+                  message: __(
+                    'Auto Reconciliation queued. You will be notified once it is complete.'
+                  ),
+                  indicator: 'blue'
+                });
               }
             }
           });
@@ -2,17 +2,19 @@
 # For license information, please see license.txt
 
 import os
-import csv
 import json
+import re
 import zipfile
 import datetime
+import functools
+import heapq
+import itertools
 from typing import Union
-import xml.etree.ElementTree as ET
 import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.query_builder.custom import ConstantColumn
-from frappe.utils import cint, flt, sbool
+from frappe.utils import cint, escape_html, flt, sbool
 from frappe.query_builder.functions import Cast, Coalesce
 
 from erpnext import get_company_currency, get_default_cost_center
@@ -24,12 +26,48 @@ from erpnext.accounts.utils import get_account_currency
 from camt_import.camt_import.doctype.transaction_matching_tool.utils import (
 	amount_rank_condition,
 	get_description_match_condition,
+	is_reference_provided,
 	ref_equality_condition,
 )
 
 from pypika import Order
+from pypika.terms import Criterion, Field, NullValue, Parameter
+from lxml import etree
 
 MAX_QUERY_RESULTS = 150
+ZERO_RANK = Cast(0, "int")
+# Matching queries order by the selected alias, so the rank is only computed once per row
+RANK_COLUMN = Field("rank")
+# Auto reconciliation allocates the best few matches only
+AUTO_RECONCILE_MAX_RESULTS = 10
+AUTO_RECONCILE_CHUNK_SIZE = 50  # Bank Transactions per background job
+AUTO_RECONCILE_CACHE_EXPIRY = 6 * 60 * 60
+AUTO_RECONCILE_SAVEPOINT = "auto_reconcile_transaction"
+CAMT_IMPORT_SAVEPOINT = "camt_import_entry"
+CAMT_NAMESPACES = (
+	"urn:iso:std:iso:20022:tech:xsd:camt.053.001.02",
+	"urn:iso:std:iso:20022:tech:xsd:camt.053.001.04",
+	"urn:iso:std:iso:20022:tech:xsd:camt.053.001.08",
+	"urn:iso:std:iso:20022:tech:xsd:camt.054.001.02",
+	"urn:iso:std:iso:20022:tech:xsd:camt.054.001.04",
+	"urn:iso:std:iso:20022:tech:xsd:camt.054.001.08",
+)
+# `xmlns` / `xmlns:prefix` declaration of a CAMT namespace in the document head
+CAMT_NAMESPACE_PATTERN = re.compile(rb"""xmlns(?::[\w.-]+)?=["']([^"']*camt\.\d+\.\d+\.\d+)["']""")
+NAMESPACE_SNIFF_SIZE = 512
+# CAMT files never need a DTD or entities: skip (and refuse) all of it
+LXML_PARSER_OPTIONS = {
+	"resolve_entities": False,
+	"no_network": True,
+	"load_dtd": False,
+	"huge_tree": False,
+	"remove_blank_text": True,
+	"remove_comments": True,
+	"remove_pis": True,
+}
+
+class CamtImportError(frappe.ValidationError):
+	pass
 
 
 class TransactionMatchingTool(Document):
@@ -44,18 +82,6 @@ def get_bank_transactions(
 	order_by: str | datetime.date = "date asc",
 ):
 	"""Return bank transactions for a bank account"""
-	filters = [
-		["bank_account", "=", bank_account],
-		["docstatus", "=", 1],
-		["unallocated_amount", ">", 0.001],
-	]
-
-	if to_date:
-		filters.append(["date", "<=", to_date])
-
-	if from_date:
-		filters.append(["date", ">=", from_date])
-
 	return frappe.get_list(
 		"Bank Transaction",
 		fields=[
@@ -75,11 +101,32 @@ def get_bank_transactions(
 			"bank_party_account_number",
 			"bank_party_iban",
 		],
-		filters=filters,
+		filters=get_bank_transaction_filters(bank_account, from_date, to_date),
 		order_by=order_by,
 	)
 
 
+def get_bank_transaction_filters(
+	bank_account: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+) -> list:
+	"""Filters for the unreconciled bank transactions of a bank account"""
+	filters = [
+		["bank_account", "=", bank_account],
+		["docstatus", "=", 1],
+		["unallocated_amount", ">", 0.001],
+	]
+
+	if to_date:
+		filters.append(["date", "<=", to_date])
+
+	if from_date:
+		filters.append(["date", ">=", from_date])
+
+	return filters
+
+
 @frappe.whitelist()
 def create_journal_entry_bts(
 	bank_transaction_name: str,
@@ -116,15 +163,15 @@ def create_journal_entry_bts(
 		bank_transaction.unallocated_amount if bank_transaction.withdrawal > 0.0 else 0.0
 	)
 
-	company_account = frappe.get_value(
-		"Bank Account", bank_transaction.bank_account, "account"
+	accounts = get_journal_entry_accounts(bank_transaction.bank_account, second_account)
+	company_account, company, company_currency = (
+		accounts.company_account,
+		accounts.company,
+		accounts.company_currency,
 	)
-	company, company_currency = frappe.get_value(
-		"Account", company_account, ["company", "account_currency"]
-	)
-
-	second_account_type, second_account_currency = frappe.db.get_value(
-		"Account", second_account, ["account_type", "account_currency"]
+	second_account_type, second_account_currency = (
+		accounts.second_account_type,
+		accounts.second_account_currency,
 	)
 	if second_account_type in ["Receivable", "Payable"] and not (party_type and party):
 		frappe.throw(
@@ -140,6 +187,7 @@ def create_journal_entry_bts(
 			).format(second_account, company_currency)
 		)
 
+	cost_center = get_default_cost_center(company)
 	journal_entry = frappe.new_doc("Journal Entry")
 	journal_entry.update(
 		{
@@ -161,14 +209,14 @@ def create_journal_entry_bts(
 				"debit_in_account_currency": bank_credit_amount,
 				"party_type": party_type,
 				"party": party,
-				"cost_center": get_default_cost_center(company),
+				"cost_center": cost_center,
 			},
 			{
 				"account": company_account,
 				"bank_account": bank_transaction.bank_account,
 				"credit_in_account_currency": bank_credit_amount,
 				"debit_in_account_currency": bank_debit_amount,
-				"cost_center": get_default_cost_center(company),
+				"cost_center": cost_center,
 			},
 		],
 	)
@@ -209,6 +257,34 @@ def create_journal_entry_bts(
 	)
 
 
+def get_journal_entry_accounts(bank_account: str, second_account: str) -> frappe._dict:
+	"""Bank account's GL account details and second account details in one query"""
+	ba = frappe.qb.DocType("Bank Account")
+	account = frappe.qb.DocType("Account")
+	second = frappe.qb.DocType("Account").as_("second_account")
+
+	accounts = (
+		frappe.qb.from_(ba)
+		.join(account)
+		.on(account.name == ba.account)
+		.left_join(second)
+		.on(second.name == second_account)
+		.select(
+			ba.account.as_("company_account"),
+			account.company,
+			account.account_currency.as_("company_currency"),
+			second.account_type.as_("second_account_type"),
+			second.account_currency.as_("second_account_currency"),
+		)
+		.where(ba.name == bank_account)
+	).run(as_dict=True)
+
+	if not accounts:
+		frappe.throw(_("No account found for Bank Account {0}").format(bank_account))
+
+	return accounts[0]
+
+
 @frappe.whitelist()
 def create_payment_entry_bts(
 	bank_transaction_name: str,
@@ -293,9 +369,16 @@ def bulk_reconcile_vouchers(
 	if isinstance(vouchers, str):
 		vouchers = json.loads(vouchers)
 
-	reconcile_multi_party = sbool(reconcile_multi_party)
-
 	transaction = frappe.get_doc("Bank Transaction", bank_transaction_name)
+	return _bulk_reconcile_vouchers(transaction, vouchers, sbool(reconcile_multi_party))
+
+
+def _bulk_reconcile_vouchers(
+	transaction: "BankTransaction",
+	vouchers: list[dict],
+	reconcile_multi_party: bool = False,
+) -> "BankTransaction":
+	"""Reconcile multiple vouchers with an already loaded bank transaction."""
 	transaction.add_payment_entries(vouchers, reconcile_multi_party)
 	transaction.validate_duplicate_references()
 	transaction.allocate_payment_entries()
@@ -360,70 +443,426 @@ def auto_reconcile_vouchers(
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
 ):
-	# Auto reconcile vouchers with matching reference numbers
-	frappe.flags.auto_reconcile_vouchers = True
-	reconciled, partially_reconciled = set(), set()
+	"""
+	Auto reconcile vouchers with matching reference numbers.
 
-	bank_transactions = get_bank_transactions(bank_account, from_date, to_date)
-	for transaction in bank_transactions:
-		linked_payments = get_linked_payments(
-			transaction.name,
-			["payment_entry", "journal_entry"],
-			from_date,
-			to_date,
-			filter_by_reference_date,
-			from_reference_date,
-			to_reference_date,
+	The bank transactions are split into chunks that are reconciled by background
+	jobs, one after another; the last job reports the result. Returns the batch id.
+	"""
+	frappe.has_permission("Bank Transaction", throw=True)
+
+	batch_id = frappe.generate_hash(length=10)
+	cache = frappe.cache()
+	# Parallel jobs could allocate the same voucher to several transactions: only
+	# one batch per bank account, and its chunks run one after another
+	lock_key = cache.make_key(get_auto_reconcile_lock_key(bank_account))
+	if not cache.set(lock_key, batch_id, ex=AUTO_RECONCILE_CACHE_EXPIRY, nx=True):
+		frappe.throw(
+			_("Auto Reconciliation is already running for Bank Account {0}").format(
+				frappe.bold(bank_account)
+			)
 		)
 
-		if not linked_payments:
-			continue
+	filters = {
+		"from_date": from_date,
+		"to_date": to_date,
+		"filter_by_reference_date": filter_by_reference_date,
+		"from_reference_date": from_reference_date,
+		"to_reference_date": to_reference_date,
+	}
+	chunks_key = get_auto_reconcile_key(batch_id, "chunks")
+	try:
+		chunks = iter_chunks(
+			iter_bank_transaction_names(bank_account, from_date, to_date),
+			AUTO_RECONCILE_CHUNK_SIZE,
+		)
+		first_chunk = next(chunks, None)
+		# The others wait in the cache until the previous chunk is done
+		for chunk in chunks:
+			cache.rpush(chunks_key, json.dumps(chunk))
+	except Exception:
+		cache.delete(lock_key, cache.make_key(chunks_key))
+		raise
+
+	if not first_chunk:
+		cache.delete(lock_key)
+		notify_auto_reconcile_result(set(), set())
+		return None
+
+	cache.expire(cache.make_key(chunks_key), AUTO_RECONCILE_CACHE_EXPIRY)
+	# The job starts after the commit, i.e. once all chunks are in the cache
+	enqueue_reconcile_chunk(batch_id, bank_account, first_chunk, filters, enqueue_after_commit=True)
+	return batch_id
+
+
+def enqueue_reconcile_chunk(
+	batch_id: str,
+	bank_account: str,
+	transaction_names: list,
+	filters: dict,
+	enqueue_after_commit: bool = False,
+):
+	frappe.enqueue(
+		"camt_import.camt_import.doctype.transaction_matching_tool.transaction_matching_tool._reconcile_chunk",
+		queue="long",
+		enqueue_after_commit=enqueue_after_commit,
+		batch_id=batch_id,
+		bank_account=bank_account,
+		transaction_names=transaction_names,
+		**filters,
+	)
+
+
+def iter_bank_transaction_names(
+	bank_account: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	page_length: int = 500,
+):
+	"""Yield the names of the unreconciled bank transactions of a bank account, page by page"""
+	filters = get_bank_transaction_filters(bank_account, from_date, to_date)
+	limit_start = 0
+	while True:
+		# Permission aware: a chunk must not fail on a transaction the user cannot access
+		names = frappe.get_list(
+			"Bank Transaction",
+			filters=filters,
+			pluck="name",
+			# Unique sort key, so that the pages do not overlap
+			order_by="date asc, name asc",
+			limit_start=limit_start,
+			limit_page_length=page_length,
+		)
+		yield from names
+
+		if len(names) < page_length:
+			return
+		limit_start += page_length
+
+
+def iter_chunks(iterable, size: int):
+	"""Yield lists of up to `size` items"""
+	iterator = iter(iterable)
+	while chunk := list(itertools.islice(iterator, size)):
+		yield chunk
+
+
+def _reconcile_chunk(
+	batch_id: str,
+	bank_account: str,
+	transaction_names: list,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	filter_by_reference_date: str | bool = False,
+	from_reference_date: str | datetime.date = None,
+	to_reference_date: str | datetime.date = None,
+):
+	"""Background job: auto reconcile one chunk of bank transactions"""
+	frappe.flags.auto_reconcile_vouchers = True
+	# `_bulk_reconcile_vouchers` saves after allocating: skip the intermediate save
+	frappe.flags.skip_bank_transaction_recompute = True
+	reconciled, partially_reconciled, failed = set(), set(), set()
+	chunk_failed = True
 
-		vouchers = list(
-			map(
-				lambda entry: {
-					"payment_doctype": entry.get("doctype"),
-					"payment_name": entry.get("name"),
-					"amount": entry.get("paid_amount"),
-				},
-				linked_payments,
+	try:
+		# Re-read: transactions may have been reconciled since the job was queued
+		bank_transactions = frappe.get_all(
+			"Bank Transaction",
+			fields=["name", "unallocated_amount", "reference_number"],
+			filters=[
+				["name", "in", transaction_names],
+				["docstatus", "=", 1],
+				["unallocated_amount", ">", 0.001],
+			],
+			order_by="date asc",
+		)
+		# Same bank account for the whole chunk: look up its details only once
+		gl_account, company = frappe.db.get_value(
+			"Bank Account", bank_account, ["account", "company"]
+		)
+		currency = get_account_currency(gl_account)
+		# Queries of other apps may match on anything: only prefilter our own
+		reference_numbers = (
+			None
+			if has_external_matching_queries()
+			else get_matchable_reference_numbers(
+				gl_account, {transaction.reference_number for transaction in bank_transactions}
 			)
 		)
 
-		unallocated_before = transaction.unallocated_amount
-		transaction = bulk_reconcile_vouchers(transaction.name, json.dumps(vouchers))
+		for transaction in bank_transactions:
+			if reference_numbers is not None and (
+				normalize_reference(transaction.reference_number) not in reference_numbers
+			):
+				# Auto reconciliation only matches on equal reference numbers
+				continue
+
+			# A failing transaction must not undo the others of the chunk
+			frappe.db.savepoint(AUTO_RECONCILE_SAVEPOINT)
+			try:
+				status = auto_reconcile_transaction(
+					transaction,
+					gl_account,
+					company,
+					currency,
+					from_date,
+					to_date,
+					sbool(filter_by_reference_date),
+					from_reference_date,
+					to_reference_date,
+				)
+			except Exception:
+				frappe.db.rollback(save_point=AUTO_RECONCILE_SAVEPOINT)
+				frappe.log_error(
+					title=_("Auto Reconciliation failed"),
+					reference_doctype="Bank Transaction",
+					reference_name=transaction.name,
+				)
+				failed.add(transaction.name)
+				continue
+
+			if status == "Reconciled":
+				reconciled.add(transaction.name)
+			elif status == "Partially Reconciled":
+				partially_reconciled.add(transaction.name)
+
+		# Keep the progress of this chunk even if a later chunk fails
+		frappe.db.commit()
+		chunk_failed = False
+	finally:
+		frappe.flags.auto_reconcile_vouchers = False
+		frappe.flags.skip_bank_transaction_recompute = False
+		if chunk_failed:
+			# Nothing of this chunk was committed; undo it before the next chunk starts
+			frappe.db.rollback()
+			reconciled, partially_reconciled = set(), set()
+
+		next_chunk = collect_auto_reconcile_result(
+			batch_id, bank_account, reconciled, partially_reconciled, failed, chunk_failed
+		)
+		if next_chunk:
+			filters = {
+				"from_date": from_date,
+				"to_date": to_date,
+				"filter_by_reference_date": filter_by_reference_date,
+				"from_reference_date": from_reference_date,
+				"to_reference_date": to_reference_date,
+			}
+			enqueue_reconcile_chunk(batch_id, bank_account, next_chunk, filters)
+
+
+def auto_reconcile_transaction(
+	transaction: frappe._dict,
+	gl_account: str,
+	company: str,
+	currency: str,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	filter_by_reference_date: bool = False,
+	from_reference_date: str | datetime.date = None,
+	to_reference_date: str | datetime.date = None,
+) -> str | None:
+	"""Reconcile one bank transaction with its best matches. Returns the new status, if it changed."""
+	bank_transaction = frappe.get_doc("Bank Transaction", transaction.name)
+	bank_transaction.check_permission("read")
+	linked_payments = get_transaction_matches(
+		bank_transaction,
+		["payment_entry", "journal_entry"],
+		gl_account,
+		company,
+		currency,
+		from_date,
+		to_date,
+		filter_by_reference_date,
+		from_reference_date,
+		to_reference_date,
+		top_k=AUTO_RECONCILE_MAX_RESULTS,
+		# Allocating re-reads the existing allocations of paid vouchers anyway
+		with_allocations=False,
+	)
+
+	if not linked_payments:
+		return None
+
+	vouchers = [
+		{
+			"payment_doctype": entry["doctype"],
+			"payment_name": entry["name"],
+			"amount": entry["paid_amount"],
+		}
+		for entry in linked_payments
+	]
+
+	bank_transaction = _bulk_reconcile_vouchers(bank_transaction, vouchers)
+
+	if bank_transaction.status == "Reconciled":
+		return "Reconciled"
+	if flt(transaction.unallocated_amount) != flt(bank_transaction.unallocated_amount):
+		return "Partially Reconciled"
+	return None
+
+
+def get_matchable_reference_numbers(gl_account: str, reference_numbers: set) -> set:
+	"""
+	Return the reference numbers used by uncleared Payment / Journal Entries of
+	`gl_account`, with one query per doctype for a whole chunk of transactions.
+
+	The numbers are normalized (see `normalize_reference`): SQL equality ignores
+	case and trailing spaces, so the membership test in Python has to as well.
+	"""
+	reference_numbers = [ref for ref in reference_numbers if ref]
+	if not reference_numbers:
+		return set()
+
+	pe = frappe.qb.DocType("Payment Entry")
+	je = frappe.qb.DocType("Journal Entry")
+	jea = frappe.qb.DocType("Journal Entry Account")
+
+	pe_references = (
+		frappe.qb.from_(pe)
+		.select(pe.reference_no)
+		.distinct()
+		.where(pe.docstatus == 1)
+		.where(pe.clearance_date.isnull())
+		.where((pe.paid_from == gl_account) | (pe.paid_to == gl_account))
+		.where(pe.reference_no.isin(reference_numbers))
+		.run(pluck=True)
+	)
+	je_references = (
+		frappe.qb.from_(jea)
+		.join(je)
+		.on(jea.parent == je.name)
+		.select(je.cheque_no)
+		.distinct()
+		.where(je.docstatus == 1)
+		.where(je.voucher_type != "Opening Entry")
+		.where(je.clearance_date.isnull())
+		.where(jea.account == gl_account)
+		.where(je.cheque_no.isin(reference_numbers))
+		.run(pluck=True)
+	)
+
+	return {normalize_reference(ref) for ref in itertools.chain(pe_references, je_references)}
+
+
+def normalize_reference(reference_number: str | None) -> str:
+	"""Compare reference numbers like the (case-insensitive, PAD SPACE) collation does"""
+	return (reference_number or "").strip().casefold()
+
+
+def has_external_matching_queries() -> bool:
+	"""Check if apps other than ERPNext and this one add matching queries"""
+	own_method = f"{__name__}.get_matching_queries"
+	return any(
+		method_name != own_method
+		for method_name in frappe.get_hooks("get_matching_queries")[1:]
+	)
+
+
+def collect_auto_reconcile_result(
+	batch_id: str,
+	bank_account: str,
+	reconciled: set,
+	partially_reconciled: set,
+	failed: set = None,
+	chunk_failed: bool = False,
+):
+	"""
+	Add the result of a chunk and return the next chunk of the batch, if any.
+	After the last chunk, report the total.
+	"""
+	cache = frappe.cache()
+	for status, names in (
+		("reconciled", reconciled),
+		("partially_reconciled", partially_reconciled),
+		("failed", failed),
+	):
+		if names:
+			key = get_auto_reconcile_key(batch_id, status)
+			cache.sadd(key, *names)
+			# Left over if the batch never finishes, e.g. when a worker is killed
+			cache.expire(cache.make_key(key), AUTO_RECONCILE_CACHE_EXPIRY)
+
+	if chunk_failed:
+		failed_chunks_key = cache.make_key(get_auto_reconcile_key(batch_id, "failed_chunks"))
+		cache.incr(failed_chunks_key)
+		cache.expire(failed_chunks_key, AUTO_RECONCILE_CACHE_EXPIRY)
+
+	if next_chunk := cache.lpop(get_auto_reconcile_key(batch_id, "chunks")):
+		return json.loads(next_chunk)
+
+	keys = [
+		get_auto_reconcile_key(batch_id, name)
+		for name in ("chunks", "reconciled", "partially_reconciled", "failed", "failed_chunks")
+	]
+	notify_auto_reconcile_result(
+		cache.smembers(keys[1]),
+		cache.smembers(keys[2]),
+		failed=cache.smembers(keys[3]),
+		failed_chunks=cint(cache.get(cache.make_key(keys[4]))),
+		realtime=True,
+	)
+	cache.delete(
+		*(cache.make_key(key) for key in keys),
+		cache.make_key(get_auto_reconcile_lock_key(bank_account)),
+	)
+	# Lets the open Transaction Matching Tool reload its transactions
+	frappe.publish_realtime(
+		"auto_reconcile_complete", {"bank_account": bank_account}, user=frappe.session.user
+	)
+	return None
+
 
-		if transaction.status == "Reconciled":
-			reconciled.add(transaction.name)
-		elif flt(unallocated_before) != flt(transaction.unallocated_amount):
-			partially_reconciled.add(transaction.name)  # Partially reconciled
+def get_auto_reconcile_key(batch_id: str, name: str) -> str:
+	return f"auto_recon:{batch_id}:{name}"
 
-	alert_message, indicator = "", "blue"
+
+def get_auto_reconcile_lock_key(bank_account: str) -> str:
+	return f"auto_recon:running:{bank_account}"
+
+
+def notify_auto_reconcile_result(
+	reconciled: set,
+	partially_reconciled: set,
+	failed: set = None,
+	failed_chunks: int = 0,
+	realtime: bool = False,
+):
+	lines, indicator = [], "blue"
 	if not partially_reconciled and not reconciled:
-		alert_message = _("No matches occurred via Auto Reconciliation")
+		lines.append(_("No matches occurred via Auto Reconciliation"))
+
+	for names, label, status_indicator in (
+		(reconciled, _("Reconciled"), "green"),
+		(partially_reconciled, _("Partially Reconciled"), "green"),
+		(failed, _("Failed"), "orange"),
+	):
+		if names:
+			lines.append(
+				_("{0} {1} {2}").format(
+					len(names),
+					_("Transactions") if len(names) > 1 else _("Transaction"),
+					frappe.bold(label),
+				)
+			)
+			indicator = status_indicator
 
-	if reconciled:
-		alert_message += _("{0} {1} {2}").format(
-			len(reconciled),
-			_("Transactions") if len(reconciled) > 1 else _("Transaction"),
-			frappe.bold(_("Reconciled")),
-		)
-		alert_message += "<br>"
-		indicator = "green"
-
-	if partially_reconciled:
-		alert_message += _("{0} {1} {2}").format(
-			len(partially_reconciled),
-			_("Transactions") if len(partially_reconciled) > 1 else _("Transaction"),
-			frappe.bold(_("Partially Reconciled")),
+	if failed_chunks:
+		# The whole chunk was rolled back; its error is in the Error Log
+		lines.append(
+			_("{0} {1} failed, see the Error Log").format(
+				failed_chunks, _("Batches") if failed_chunks > 1 else _("Batch")
+			)
 		)
-		indicator = "green"
+		indicator = "red"
 
+	alert_message = "<br>".join(lines)
 	frappe.msgprint(
-		title=_("Auto Reconciliation Complete"), msg=alert_message, indicator=indicator
+		title=_("Auto Reconciliation Complete"),
+		msg=alert_message,
+		indicator=indicator,
+		realtime=realtime,
 	)
-	frappe.flags.auto_reconcile_vouchers = False
-	return reconciled, partially_reconciled
 
 
 @frappe.whitelist()
@@ -447,6 +886,38 @@ def get_linked_payments(
 	if isinstance(document_types, str):
 		document_types = json.loads(document_types)
 
+	return get_transaction_matches(
+		transaction,
+		document_types,
+		gl_account,
+		company,
+		from_date=from_date,
+		to_date=to_date,
+		filter_by_reference_date=sbool(filter_by_reference_date),
+		from_reference_date=from_reference_date,
+		to_reference_date=to_reference_date,
+	)
+
+
+def get_transaction_matches(
+	transaction: "BankTransaction",
+	document_types: list,
+	gl_account: str,
+	company: str,
+	currency: str = None,
+	from_date: str | datetime.date = None,
+	to_date: str | datetime.date = None,
+	filter_by_reference_date: bool = False,
+	from_reference_date: str | datetime.date = None,
+	to_reference_date: str | datetime.date = None,
+	top_k: int = None,
+	with_allocations: bool = True,
+) -> list:
+	"""
+	Get all (or the `top_k` best) matching payments for an already loaded bank transaction.
+
+	:param with_allocations: subtract existing Bank Transaction allocations from `paid_amount`
+	"""
 	matching = check_matching(
 		gl_account,
 		company,
@@ -454,16 +925,29 @@ def get_linked_payments(
 		document_types,
 		from_date,
 		to_date,
-		sbool(filter_by_reference_date),
+		filter_by_reference_date,
 		from_reference_date,
 		to_reference_date,
+		currency,
+		top_k,
 	)
-	subtract_allocations(gl_account, matching)
+	if with_allocations:
+		subtract_allocations(gl_account, matching, document_types)
 
 	return matching
 
 
-def subtract_allocations(gl_account, vouchers):
+def get_allocatable_doctypes(document_types: list = None) -> set:
+	"""Voucher types that can already be allocated to a Bank Transaction (`Bank Transaction Payments`)"""
+	# Registered by ERPNext and other apps (e.g. Lending for loans)
+	doctypes = set(frappe.get_hooks("bank_reconciliation_doctypes"))
+	if document_types and "unpaid_invoices" in document_types:
+		# Only unpaid invoices are matched then, and those are never allocated directly
+		doctypes -= {"Sales Invoice", "Purchase Invoice"}
+	return doctypes
+
+
+def subtract_allocations(gl_account, vouchers, document_types: list = None):
 	"""Look up & subtract any existing Bank Transaction allocations.
 
 	For example, assume `vouchers` contains a Payment Entry of 300 that already
@@ -474,21 +958,33 @@ def subtract_allocations(gl_account, vouchers):
 	This does not affect "unpaid" vouchers (e.g. unpaid invoices) since they
 	are never directly allocated to a Bank Transaction.
 	"""
-	rows = get_total_allocated_amount(
-		[(voucher.get("doctype"), voucher.get("name")) for voucher in vouchers]
+	# Unique keys of the vouchers that can be a Bank Transaction payment
+	allocatable_doctypes = get_allocatable_doctypes(document_types)
+	keys = list(
+		dict.fromkeys(
+			(voucher.get("doctype"), voucher.get("name"))
+			for voucher in vouchers
+			if voucher.get("doctype") in allocatable_doctypes
+		)
 	)
+	if not keys:
+		return
+
+	rows = get_total_allocated_amount(keys)
 
 	if not rows:
 		return
 
-	for voucher in vouchers:
-		for (doctype, name), values in rows.items():
-			if doctype != voucher.get("doctype") or name != voucher.get("name"):
-				continue
+	# Allocated total per voucher on this GL account
+	allocated = {
+		key: sum(value["total"] for value in values if value["gl_account"] == gl_account)
+		for key, values in rows.items()
+	}
 
-			for value in values:
-				if value["gl_account"] == gl_account:
-					voucher["paid_amount"] -= value["total"]
+	for voucher in vouchers:
+		total = allocated.get((voucher.get("doctype"), voucher.get("name")))
+		if total:
+			voucher["paid_amount"] -= total
 
 
 def check_matching(
@@ -501,6 +997,8 @@ def check_matching(
 	filter_by_reference_date: bool = False,
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
+	currency: str = None,
+	top_k: int = None,
 ):
 	common_filters = frappe._dict(
 		amount=transaction.unallocated_amount,
@@ -510,6 +1008,7 @@ def check_matching(
 		party=transaction.party,
 		bank_account=bank_account,
 		date=transaction.date,
+		currency=currency,
 	)
 
 	# combine all types of vouchers
@@ -528,23 +1027,42 @@ def check_matching(
 
 	matching_vouchers = []
 	for query in queries:
-		matching_vouchers.extend(query.run(as_dict=True))
+		vouchers = query.run(as_dict=True)
+		matching_vouchers.extend(vouchers)
+
+		if frappe.flags.auto_reconcile_vouchers and any(
+			voucher.get("reference_number_match") and voucher.get("amount_match")
+			for voucher in vouchers
+		):
+			# Same reference and amount allocates the whole transaction
+			break
 
 	if not matching_vouchers:
 		return []
 
 	if transaction.description:
-		for voucher in matching_vouchers:
-			if "name_in_desc_match" in voucher:
-				# already covered in DB query
-				continue
+		# already covered in DB query (queries of other apps may not be)
+		unranked = [
+			voucher for voucher in matching_vouchers if "name_in_desc_match" not in voucher
+		]
+		# Search the description once per distinct reference, not once per voucher
+		references_in_description = {
+			reference
+			for reference in {(voucher["reference_no"] or "").strip() for voucher in unranked}
+			if reference and reference in transaction.description
+		}
 
+		for voucher in unranked:
 			# higher rank if voucher name is in bank transaction
 			reference_no = voucher["reference_no"]
-			if reference_no and (reference_no.strip() in transaction.description):
+			if reference_no and reference_no.strip() in references_in_description:
 				voucher["rank"] += 1
 				voucher["name_in_desc_match"] = 1
 
+	if top_k:
+		# Same order as the full sort, without sorting the rows that are dropped
+		return heapq.nlargest(top_k, matching_vouchers, key=lambda x: x["rank"])
+
 	return sorted(matching_vouchers, key=lambda x: x["rank"], reverse=True)
 
 
@@ -606,7 +1124,7 @@ def get_matching_queries(
 		common_filters = frappe._dict()
 
 	queries = []
-	currency = get_account_currency(bank_account)
+	currency = common_filters.currency or get_account_currency(bank_account)
 	is_withdrawal = transaction.withdrawal > 0.0
 	is_deposit = transaction.deposit > 0.0
 
@@ -643,7 +1161,7 @@ def get_matching_queries(
 	# -- Invoices --
 	include_unpaid = "unpaid_invoices" in document_types
 	invoice_dt = "sales_invoice" if is_deposit else "purchase_invoice"
-	invoice_queries_map = get_invoice_function_map(document_types, is_deposit)
+	invoice_functions = iter_invoice_functions(document_types, is_deposit, currency, company)
 	reference_field_map = {}
 
 	kwargs = frappe._dict(
@@ -653,7 +1171,8 @@ def get_matching_queries(
 	)
 	if include_unpaid:
 		kwargs.company = company
-		for doctype, fn in invoice_queries_map.items():
+		invoice_queries = []
+		for doctype, fn in invoice_functions:
 			frappe.has_permission(frappe.unscrub(doctype), throw=True)
 			kwargs.reference_field = reference_field_map.get(doctype, "name")
 			if doctype in ["sales_invoice", "purchase_invoice"]:
@@ -662,8 +1181,12 @@ def get_matching_queries(
 				# Remove the key when doctype == "expense_claim"
 				del kwargs.include_only_returns
 
-			queries.append(fn(**kwargs))
-	elif fn := invoice_queries_map.get(invoice_dt):
+			invoice_queries.append(fn(**kwargs))
+
+		if invoice_queries:
+			# One round trip for all invoice doctypes
+			queries.append(functools.reduce(lambda a, b: a.union_all(b), invoice_queries))
+	elif fn := next((fn for doctype, fn in invoice_functions if doctype == invoice_dt), None):
 		frappe.has_permission(frappe.unscrub(invoice_dt), throw=True)
 		kwargs.reference_field = reference_field_map.get(invoice_dt, "name")
 		queries.append(fn(**kwargs))
@@ -684,13 +1207,20 @@ def get_matching_queries(
 	return queries
 
 
+def get_query_limit() -> int:
+	"""Number of candidates a matching query returns"""
+	if frappe.flags.auto_reconcile_vouchers:
+		return AUTO_RECONCILE_MAX_RESULTS
+	return MAX_QUERY_RESULTS
+
+
 def get_bt_matching_query(
 	exact_match: bool, common_filters: frappe._dict, transaction_name: str
 ):
 	# get matching bank transaction query
 	# find bank transactions in the same bank account with opposite sign
 	# same bank account must have same company and currency
-	bt = frappe.qb.DocType("Bank Transaction")
+	bt = get_table("Bank Transaction")
 	field = "deposit" if common_filters.payment_type == "Pay" else "withdrawal"
 	amount_field = getattr(bt, field)
 
@@ -713,7 +1243,13 @@ def get_bt_matching_query(
 	)
 	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
 
-	rank_expression = ref_rank + amount_rank + party_rank + unallocated_rank + 1
+	desc_rank = get_description_match_condition(
+		common_filters.description, bt, "reference_number"
+	)
+
+	rank_expression = (
+		ref_rank + amount_rank + party_rank + unallocated_rank + desc_rank + 1
+	)
 
 	query = (
 		frappe.qb.from_(bt)
@@ -732,14 +1268,17 @@ def get_bt_matching_query(
 			amount_rank.as_("amount_match"),
 			party_rank.as_("party_match"),
 			unallocated_rank.as_("unallocated_amount_match"),
+			desc_rank.as_("name_in_desc_match"),
 		)
-		.where(bt.status != "Reconciled")
-		.where(bt.name != transaction_name)
-		.where(bt.bank_account == common_filters.bank_account)
-		.where(amount_filter)
-		.where(bt.docstatus == 1)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
+		.where(
+			(bt.status != "Reconciled")
+			& (bt.name != transaction_name)
+			& (bt.bank_account == common_filters.bank_account)
+			& amount_filter
+			& (bt.docstatus == 1)
+		)
+		.orderby(RANK_COLUMN, order=Order.desc)
+		.limit(get_query_limit())
 	)
 
 	if common_filters.exact_party_match:
@@ -749,10 +1288,9 @@ def get_bt_matching_query(
 
 
 def get_ld_matching_query(exact_match: bool, common_filters: frappe._dict):
-	loan_disbursement = frappe.qb.DocType("Loan Disbursement")
-	matching_party = (
-		loan_disbursement.applicant_type == common_filters.party_type
-		and loan_disbursement.applicant == common_filters.matching_party
+	loan_disbursement = get_table("Loan Disbursement")
+	matching_party = (loan_disbursement.applicant_type == common_filters.party_type) & (
+		loan_disbursement.applicant == common_filters.party
 	)
 
 	date_condition = (
@@ -765,8 +1303,20 @@ def get_ld_matching_query(exact_match: bool, common_filters: frappe._dict):
 		loan_disbursement.reference_number, common_filters.reference_no
 	)
 	party_rank = frappe.qb.terms.Case().when(matching_party, 1).else_(0)
+	desc_rank = get_description_match_condition(
+		common_filters.description, loan_disbursement, "reference_number"
+	)
 
-	rank_expression = reference_rank + party_rank + date_rank + 1
+	rank_expression = reference_rank + party_rank + date_rank + desc_rank + 1
+
+	conditions = [
+		loan_disbursement.docstatus == 1,
+		loan_disbursement.clearance_date.isnull(),
+		loan_disbursement.disbursement_account == common_filters.bank_account,
+		loan_disbursement.disbursed_amount == common_filters.amount
+		if exact_match
+		else loan_disbursement.disbursed_amount > 0.0,
+	]
 
 	query = (
 		frappe.qb.from_(loan_disbursement)
@@ -784,27 +1334,20 @@ def get_ld_matching_query(exact_match: bool, common_filters: frappe._dict):
 			reference_rank.as_("reference_number_match"),
 			party_rank.as_("party_match"),
 			date_rank.as_("date_match"),
+			desc_rank.as_("name_in_desc_match"),
 		)
-		.where(loan_disbursement.docstatus == 1)
-		.where(loan_disbursement.clearance_date.isnull())
-		.where(loan_disbursement.disbursement_account == common_filters.bank_account)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
+		.where(Criterion.all(conditions))
+		.orderby(RANK_COLUMN, order=Order.desc)
+		.limit(get_query_limit())
 	)
 
-	if exact_match:
-		query.where(loan_disbursement.disbursed_amount == common_filters.amount)
-	else:
-		query.where(loan_disbursement.disbursed_amount > 0.0)
-
 	return query
 
 
 def get_lr_matching_query(exact_match: bool, common_filters: frappe._dict):
-	loan_repayment = frappe.qb.DocType("Loan Repayment")
-	matching_party = (
-		loan_repayment.applicant_type == common_filters.party_type
-		and loan_repayment.applicant == common_filters.party
+	loan_repayment = get_table("Loan Repayment")
+	matching_party = (loan_repayment.applicant_type == common_filters.party_type) & (
+		loan_repayment.applicant == common_filters.party
 	)
 
 	date_condition = (
@@ -817,8 +1360,22 @@ def get_lr_matching_query(exact_match: bool, common_filters: frappe._dict):
 		loan_repayment.reference_number, common_filters.reference_no
 	)
 	party_rank = frappe.qb.terms.Case().when(matching_party, 1).else_(0)
+	desc_rank = get_description_match_condition(
+		common_filters.description, loan_repayment, "reference_number"
+	)
+
+	rank_expression = reference_rank + party_rank + date_rank + desc_rank + 1
 
-	rank_expression = reference_rank + party_rank + date_rank + 1
+	conditions = [
+		loan_repayment.docstatus == 1,
+		loan_repayment.clearance_date.isnull(),
+		loan_repayment.payment_account == common_filters.bank_account,
+		loan_repayment.amount_paid == common_filters.amount
+		if exact_match
+		else loan_repayment.amount_paid > 0.0,
+	]
+	if frappe.db.has_column("Loan Repayment", "repay_from_salary"):
+		conditions.append(loan_repayment.repay_from_salary == 0)
 
 	query = (
 		frappe.qb.from_(loan_repayment)
@@ -836,23 +1393,29 @@ def get_lr_matching_query(exact_match: bool, common_filters: frappe._dict):
 			reference_rank.as_("reference_number_match"),
 			party_rank.as_("party_match"),
 			date_rank.as_("date_match"),
+			desc_rank.as_("name_in_desc_match"),
 		)
-		.where(loan_repayment.docstatus == 1)
-		.where(loan_repayment.clearance_date.isnull())
-		.where(loan_repayment.payment_account == common_filters.bank_account)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
+		.where(Criterion.all(conditions))
+		.orderby(RANK_COLUMN, order=Order.desc)
+		.limit(get_query_limit())
 	)
 
-	if frappe.db.has_column("Loan Repayment", "repay_from_salary"):
-		query = query.where((loan_repayment.repay_from_salary == 0))
+	return query
 
-	if exact_match:
-		query.where(loan_repayment.amount_paid == common_filters.amount)
-	else:
-		query.where(loan_repayment.amount_paid > 0.0)
 
-	return query
+class MatchingQuery:
+	"""Cached SQL of a matching query, bound to the values of one transaction"""
+
+	def __init__(self, sql: str, values: dict):
+		self.sql = sql
+		self.values = values
+
+	def run(self, as_dict: bool = False):
+		return frappe.db.sql(self.sql, self.values, as_dict=as_dict)
+
+
+def sql_parameter(name: str) -> Parameter:
+	return Parameter(f"%({name})s")
 
 
 def get_pe_matching_query(
@@ -864,34 +1427,82 @@ def get_pe_matching_query(
 	filter_by_reference_date: bool = False,
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
-):
+) -> MatchingQuery:
+	filter_by_reference_date = bool(cint(filter_by_reference_date))
+	sql = get_pe_matching_sql(
+		frappe.db.db_type,
+		bool(exact_match),
+		account_from_to,
+		common_filters.payment_type == "Receive",
+		is_reference_provided(common_filters.reference_no),
+		bool(common_filters.description),
+		bool(common_filters.exact_party_match),
+		filter_by_reference_date,
+		bool(frappe.flags.auto_reconcile_vouchers),
+		get_query_limit(),
+	)
+
+	return MatchingQuery(
+		sql,
+		{
+			"amount": common_filters.amount,
+			"payment_type": common_filters.payment_type,
+			"reference_no": common_filters.reference_no,
+			"party": common_filters.party,
+			"party_type": common_filters.party_type,
+			"bank_account": common_filters.bank_account,
+			"date": common_filters.date,
+			"description": common_filters.description,
+			"from_date": from_reference_date if filter_by_reference_date else from_date,
+			"to_date": to_reference_date if filter_by_reference_date else to_date,
+		},
+	)
+
+
+@functools.lru_cache(maxsize=64)
+def get_pe_matching_sql(
+	db_type: str,
+	exact_match: bool,
+	account_from_to: str,
+	is_receive: bool,
+	has_reference: bool,
+	has_description: bool,
+	exact_party_match: bool,
+	filter_by_reference_date: bool,
+	auto_reconcile: bool,
+	limit: int,
+) -> str:
+	"""Build the Payment Entry matching SQL once per query shape"""
 	pe = frappe.qb.DocType("Payment Entry")
-	to_from = "to" if common_filters.payment_type == "Receive" else "from"
-	payment_type = common_filters.payment_type
+	to_from = "to" if is_receive else "from"
 	currency_field = getattr(pe, f"paid_{to_from}_account_currency")
+	amount = sql_parameter("amount")
 
-	ref_rank = ref_equality_condition(pe.reference_no, common_filters.reference_no)
-
-	amount_rank = amount_rank_condition(pe.paid_amount, common_filters.amount)
-	amount_filter = (
-		pe.paid_amount == common_filters.amount if exact_match else pe.paid_amount > 0.0
+	ref_rank = ref_equality_condition(
+		pe.reference_no, sql_parameter("reference_no") if has_reference else None
 	)
 
+	amount_rank = amount_rank_condition(pe.paid_amount, amount)
+	amount_filter = pe.paid_amount == amount if exact_match else pe.paid_amount > 0.0
+
 	party_filter = (
-		(pe.party == common_filters.party)
-		& (pe.party_type == common_filters.party_type)
+		(pe.party == sql_parameter("party"))
+		& (pe.party_type == sql_parameter("party_type"))
 		& (pe.party.isnotnull())
 	)
 	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
 
-	filter_by_date = pe.posting_date.between(from_date, to_date)
-	if cint(filter_by_reference_date):
-		filter_by_date = pe.reference_date.between(from_reference_date, to_reference_date)
+	date_field = pe.reference_date if filter_by_reference_date else pe.posting_date
+	filter_by_date = date_field.between(sql_parameter("from_date"), sql_parameter("to_date"))
 
-	date_condition = Coalesce(pe.reference_date, pe.posting_date) == common_filters.date
+	date_condition = Coalesce(pe.reference_date, pe.posting_date) == sql_parameter("date")
 	date_rank = frappe.qb.terms.Case().when(date_condition, 1).else_(0)
 
-	rank_expression = ref_rank + amount_rank + party_rank + date_rank + 1
+	desc_rank = get_description_match_condition(
+		sql_parameter("description") if has_description else None, pe, "reference_no"
+	)
+
+	rank_expression = ref_rank + amount_rank + party_rank + date_rank + desc_rank + 1
 
 	query = (
 		frappe.qb.from_(pe)
@@ -911,23 +1522,26 @@ def get_pe_matching_query(
 			amount_rank.as_("amount_match"),
 			party_rank.as_("party_match"),
 			date_rank.as_("date_match"),
+			desc_rank.as_("name_in_desc_match"),
 		)
-		.where(pe.docstatus == 1)
-		.where(pe.payment_type.isin([payment_type, "Internal Transfer"]))
-		.where(pe.clearance_date.isnull())
-		.where(getattr(pe, account_from_to) == common_filters.bank_account)
-		.where(amount_filter)
-		.where(filter_by_date)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
+		.where(
+			(pe.docstatus == 1)
+			& pe.payment_type.isin([sql_parameter("payment_type"), "Internal Transfer"])
+			& pe.clearance_date.isnull()
+			& (getattr(pe, account_from_to) == sql_parameter("bank_account"))
+			& amount_filter
+			& filter_by_date
+		)
+		.orderby(RANK_COLUMN, order=Order.desc)
+		.limit(limit)
 	)
 
-	if frappe.flags.auto_reconcile_vouchers:
-		query = query.where(pe.reference_no == common_filters.reference_no)
-	if common_filters.exact_party_match:
+	if auto_reconcile:
+		query = query.where(pe.reference_no == sql_parameter("reference_no"))
+	if exact_party_match:
 		query = query.where(party_filter)
 
-	return query
+	return query.get_sql()
 
 
 def get_je_matching_query(
@@ -938,31 +1552,73 @@ def get_je_matching_query(
 	filter_by_reference_date: bool = False,
 	from_reference_date: str | datetime.date = None,
 	to_reference_date: str | datetime.date = None,
-):
-	# get matching journal entry query
-	# We have mapping at the bank level
+) -> MatchingQuery:
+	filter_by_reference_date = bool(cint(filter_by_reference_date))
+	sql = get_je_matching_sql(
+		frappe.db.db_type,
+		bool(exact_match),
+		common_filters.payment_type == "Pay",
+		is_reference_provided(common_filters.reference_no),
+		bool(common_filters.description),
+		filter_by_reference_date,
+		bool(frappe.flags.auto_reconcile_vouchers),
+		get_query_limit(),
+	)
+
+	return MatchingQuery(
+		sql,
+		{
+			"amount": common_filters.amount,
+			"reference_no": common_filters.reference_no,
+			"bank_account": common_filters.bank_account,
+			"date": common_filters.date,
+			"description": common_filters.description,
+			"from_date": from_reference_date if filter_by_reference_date else from_date,
+			"to_date": to_reference_date if filter_by_reference_date else to_date,
+		},
+	)
+
+
+@functools.lru_cache(maxsize=32)
+def get_je_matching_sql(
+	db_type: str,
+	exact_match: bool,
+	is_pay: bool,
+	has_reference: bool,
+	has_description: bool,
+	filter_by_reference_date: bool,
+	auto_reconcile: bool,
+	limit: int,
+) -> str:
+	"""Build the Journal Entry matching SQL once per query shape"""
+	# get matching journal entry query
+	# We have mapping at the bank level
 	# So one bank could have both types of bank accounts like asset and liability
 	# So cr_or_dr should be judged only on basis of withdrawal and deposit and not account type
 	je = frappe.qb.DocType("Journal Entry")
 	jea = frappe.qb.DocType("Journal Entry Account")
 
-	cr_or_dr = "credit" if common_filters.payment_type == "Pay" else "debit"
+	cr_or_dr = "credit" if is_pay else "debit"
 	amount_field = getattr(jea, f"{cr_or_dr}_in_account_currency")
+	amount = sql_parameter("amount")
 
-	ref_rank = ref_equality_condition(je.cheque_no, common_filters.reference_no)
-	amount_rank = amount_rank_condition(amount_field, common_filters.amount)
-	amount_filter = (
-		amount_field == common_filters.amount if exact_match else amount_field > 0.0
+	ref_rank = ref_equality_condition(
+		je.cheque_no, sql_parameter("reference_no") if has_reference else None
 	)
+	amount_rank = amount_rank_condition(amount_field, amount)
+	amount_filter = amount_field == amount if exact_match else amount_field > 0.0
 
-	filter_by_date = je.posting_date.between(from_date, to_date)
-	if cint(filter_by_reference_date):
-		filter_by_date = je.cheque_date.between(from_reference_date, to_reference_date)
+	date_field = je.cheque_date if filter_by_reference_date else je.posting_date
+	filter_by_date = date_field.between(sql_parameter("from_date"), sql_parameter("to_date"))
 
-	date_condition = Coalesce(je.cheque_date, je.posting_date) == common_filters.date
+	date_condition = Coalesce(je.cheque_date, je.posting_date) == sql_parameter("date")
 	date_rank = frappe.qb.terms.Case().when(date_condition, 1).else_(0)
 
-	rank_expression = ref_rank + amount_rank + date_rank + 1
+	desc_rank = get_description_match_condition(
+		sql_parameter("description") if has_description else None, je, "cheque_no"
+	)
+
+	rank_expression = ref_rank + amount_rank + date_rank + desc_rank + 1
 
 	query = (
 		frappe.qb.from_(jea)
@@ -982,603 +1638,535 @@ def get_je_matching_query(
 			ref_rank.as_("reference_number_match"),
 			amount_rank.as_("amount_match"),
 			date_rank.as_("date_match"),
+			desc_rank.as_("name_in_desc_match"),
 		)
-		.where(je.docstatus == 1)
-		.where(je.voucher_type != "Opening Entry")
-		.where(je.clearance_date.isnull())
-		.where(jea.account == common_filters.bank_account)
-		.where(amount_filter)
-		.where(je.docstatus == 1)
-		.where(filter_by_date)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
-	)
-
-	if frappe.flags.auto_reconcile_vouchers:
-		query = query.where(je.cheque_no == common_filters.reference_no)
-
-	return query
-
-
-def get_si_matching_query(
-	exact_match: bool,
-	currency: str,
-	common_filters: frappe._dict,
-	reference_field: str = "name",
-):
-	"""
-	Get matching sales invoices when they are also used as payment entries (POS).
-	"""
-	si = frappe.qb.DocType("Sales Invoice").as_("si")
-	sip = frappe.qb.DocType("Sales Invoice Payment").as_("sip")
-	description = common_filters.description
-
-	amount_rank = amount_rank_condition(sip.amount, common_filters.amount)
-	amount_filter = (
-		sip.amount == common_filters.amount if exact_match else sip.amount != 0.0
+		.where(
+			(je.docstatus == 1)
+			& (je.voucher_type != "Opening Entry")
+			& je.clearance_date.isnull()
+			& (jea.account == sql_parameter("bank_account"))
+			& amount_filter
+			& filter_by_date
+		)
+		.orderby(RANK_COLUMN, order=Order.desc)
+		.limit(limit)
 	)
 
-	party_filter = si.customer == common_filters.party
-	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
+	if auto_reconcile:
+		query = query.where(je.cheque_no == sql_parameter("reference_no"))
 
-	date_condition = si.posting_date == common_filters.date
-	date_rank = frappe.qb.terms.Case().when(date_condition, 1).else_(0)
+	return query.get_sql()
 
-	# Check reference field equality with common_filters.reference_no
-	reference_field_is_set = reference_field and reference_field != "name"
-	reference_number = common_filters.reference_no
-	ref_rank = (
-		ref_equality_condition(si[reference_field], reference_number)
-		if (reference_number and reference_field_is_set)
-		else Cast(0, "int")
-	)
 
-	# if ref field is configured (!= name), perform desc-name and desc-ref match
-	# otherwise (== name), then perform desc-name match once
-	name_match = get_description_match_condition(description, si, "name")
-	ref_match = (
-		get_description_match_condition(description, si, reference_field)
-		if reference_field_is_set
-		else Cast(0, "int")
-	)
+@functools.lru_cache(maxsize=None)
+def get_table(doctype: str, alias: str = None):
+	"""Table of a doctype, built once per process (pypika terms are immutable)"""
+	table = frappe.qb.DocType(doctype)
+	return table.as_(alias) if alias else table
 
-	rank_expression = (
-		ref_rank + party_rank + amount_rank + date_rank + name_match + ref_match + 1
-	)
 
-	query = (
-		frappe.qb.from_(sip)
-		.join(si)
-		.on(sip.parent == si.name)
-		.select(
-			rank_expression.as_("rank"),
-			ConstantColumn("Sales Invoice").as_("doctype"),
-			si.name,
-			sip.amount.as_("paid_amount"),
-			si[reference_field or "name"].as_("reference_no"),
-			si.posting_date.as_("reference_date"),
-			si.customer.as_("party"),
-			ConstantColumn("Customer").as_("party_type"),
-			si.posting_date,
-			si.currency,
-			party_rank.as_("party_match"),
-			amount_rank.as_("amount_match"),
-			date_rank.as_("date_match"),
-			name_match.as_("name_in_desc_match"),
-			ref_match.as_("ref_in_desc_match"),
-			ref_rank.as_("reference_number_match"),
-		)
-		.where(si.docstatus == 1)
-		.where(sip.clearance_date.isnull())
-		.where(sip.account == common_filters.bank_account)
-		.where(amount_filter)
-		.where(si.currency == currency)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
+def get_expense_claim_outstanding_amount(expense_claim, payment=None):
+	return (
+		expense_claim.total_sanctioned_amount
+		+ expense_claim.total_taxes_and_charges
+		- expense_claim.total_amount_reimbursed
+		- expense_claim.total_advance_amount
 	)
 
-	if common_filters.exact_party_match:
-		query = query.where(party_filter)
 
-	return query
+# How to match each invoice doctype, keyed by (doctype, "paid" | "unpaid").
+# Paid invoices are used as payment entries (SI: POS payments, PI: is_paid),
+# unpaid ones are matched by their outstanding amount.
+MATCH_SPECS = {
+	("sales_invoice", "paid"): frappe._dict(
+		doctype="Sales Invoice",
+		payment_doctype="Sales Invoice Payment",
+		amount=lambda si, sip: sip.amount,
+		date=lambda si: si.posting_date,
+		reference_date_field="posting_date",
+		party_field="customer",
+		party_type="Customer",
+		filters=lambda si, sip, common_filters, company: [
+			sip.clearance_date.isnull(),
+			sip.account == common_filters.bank_account,
+		],
+	),
+	("sales_invoice", "unpaid"): frappe._dict(
+		doctype="Sales Invoice",
+		amount=lambda si, sip: si.outstanding_amount,
+		reference_date_field="posting_date",
+		party_field="customer",
+		party_name_field="customer_name",
+		party_type="Customer",
+		has_returns=True,
+		filters=lambda si, sip, common_filters, company: [
+			si.company == company,  # because we do not have bank account check
+		],
+	),
+	("purchase_invoice", "paid"): frappe._dict(
+		doctype="Purchase Invoice",
+		amount=lambda pi, payment: pi.paid_amount,
+		# date of BT and paid PI could be the same (date of payment or the date of the bill)
+		date=lambda pi: Coalesce(pi.bill_date, pi.posting_date),
+		# Default to bill_no instead of name
+		default_reference_field="bill_no",
+		reference_date_field="bill_date",
+		party_field="supplier",
+		party_name_field="supplier_name",
+		party_type="Supplier",
+		filters=lambda pi, payment, common_filters, company: [
+			pi.is_paid == 1,
+			pi.clearance_date.isnull(),
+			pi.cash_bank_account == common_filters.bank_account,
+		],
+	),
+	("purchase_invoice", "unpaid"): frappe._dict(
+		doctype="Purchase Invoice",
+		amount=lambda pi, payment: pi.outstanding_amount,
+		# We skip date rank as the date of an unpaid bill is mostly
+		# earlier than the date of the bank transaction
+		default_reference_field="bill_no",
+		reference_date_field="bill_date",
+		party_field="supplier",
+		party_name_field="supplier_name",
+		party_type="Supplier",
+		has_returns=True,
+		filters=lambda pi, payment, common_filters, company: [
+			pi.company == company,
+			pi.is_paid == 0,
+		],
+	),
+	("expense_claim", "unpaid"): frappe._dict(
+		doctype="Expense Claim",
+		amount=get_expense_claim_outstanding_amount,
+		reference_date_field="posting_date",
+		party_field="employee",
+		party_name_field="employee_name",
+		party_type="Employee",
+		# Expense claims are always in company currency
+		company_currency_only=True,
+		filters=lambda ec, payment, common_filters, company: [
+			ec.company == company,
+			ec.status == "Unpaid",
+		],
+	),
+}
+for _spec in MATCH_SPECS.values():
+	_spec.doctype_column = ConstantColumn(_spec.doctype)
+	_spec.party_type_column = ConstantColumn(_spec.party_type)
 
 
-def get_unpaid_si_matching_query(
+def build_invoice_matching_query(
+	spec: frappe._dict,
 	exact_match: bool,
 	currency: str,
 	common_filters: frappe._dict,
-	company: str,
+	company: str = None,
 	include_only_returns: bool = False,
 	reference_field: str = "name",
 ):
-	sales_invoice = frappe.qb.DocType("Sales Invoice")
+	"""Build the matching query of an invoice doctype described by a `MATCH_SPECS` entry."""
+	# "name" is passed when it is unset. Handle specific default here.
+	if reference_field == "name" or not reference_field:
+		reference_field = spec.default_reference_field or "name"
+
+	payment = None
+	if spec.payment_doctype:
+		invoice = get_table(spec.doctype, "si")
+		payment = get_table(spec.payment_doctype, "sip")
+	else:
+		invoice = get_table(spec.doctype)
+
 	description = common_filters.description
+	amount = spec.amount(invoice, payment)
+	amount_rank = amount_rank_condition(amount, common_filters.amount)
 
-	party_filter = sales_invoice.customer == common_filters.party
+	party_filter = invoice[spec.party_field] == common_filters.party
 	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
 
-	amount_rank = amount_rank_condition(
-		sales_invoice.outstanding_amount, common_filters.amount
-	)
+	date_rank = None
+	if spec.date:
+		date_condition = spec.date(invoice) == common_filters.date
+		date_rank = frappe.qb.terms.Case().when(date_condition, 1).else_(0)
 
 	# Check reference field equality with common_filters.reference_no
-	reference_field_is_set = reference_field and reference_field != "name"
+	reference_field_is_set = reference_field != "name"
 	reference_number = common_filters.reference_no
 	ref_rank = (
-		ref_equality_condition(sales_invoice[reference_field], reference_number)
+		ref_equality_condition(invoice[reference_field], reference_number)
 		if (reference_number and reference_field_is_set)
-		else Cast(0, "int")
+		else ZERO_RANK
 	)
 
 	# if ref field is configured (!= name), perform desc-name and desc-ref match
 	# otherwise (== name), then perform desc-name match once
-	name_match = get_description_match_condition(description, sales_invoice, "name")
+	name_match = get_description_match_condition(description, invoice, "name")
 	ref_match = (
-		get_description_match_condition(description, sales_invoice, reference_field)
+		get_description_match_condition(description, invoice, reference_field)
 		if reference_field_is_set
-		else Cast(0, "int")
+		else ZERO_RANK
 	)
 
 	rank_expression = ref_rank + party_rank + amount_rank + name_match + ref_match + 1
+	if date_rank is not None:
+		rank_expression += date_rank
+
+	# Rows without any of these signals only reach the minimum rank
+	signals = [amount == common_filters.amount]
+	if common_filters.party:
+		signals.append(party_filter)
+	if date_rank is not None:
+		signals.append(date_condition)
+	if reference_field_is_set and is_reference_provided(reference_number):
+		signals.append(invoice[reference_field] == reference_number)
+	if description:
+		signals.append(name_match == 1)
+		if reference_field_is_set:
+			signals.append(ref_match == 1)
+
+	columns = [
+		rank_expression.as_("rank"),
+		spec.doctype_column.as_("doctype"),
+		invoice.name.as_("name"),
+		amount.as_("paid_amount"),
+		invoice[reference_field].as_("reference_no"),
+		invoice[spec.reference_date_field].as_("reference_date"),
+		invoice[spec.party_field].as_("party"),
+		spec.party_type_column.as_("party_type"),
+		invoice.posting_date,
+		(ConstantColumn(currency) if spec.company_currency_only else invoice.currency).as_(
+			"currency"
+		),
+		party_rank.as_("party_match"),
+		amount_rank.as_("amount_match"),
+		name_match.as_("name_in_desc_match"),
+		ref_match.as_("ref_in_desc_match"),
+		ref_rank.as_("reference_number_match"),
+		# Same columns for every doctype, so that the queries can be combined
+		(invoice[spec.party_name_field] if spec.party_name_field else NullValue()).as_(
+			"party_name"
+		),
+		(ZERO_RANK if date_rank is None else date_rank).as_("date_match"),
+	]
 
-	query = (
-		frappe.qb.from_(sales_invoice)
-		.select(
-			rank_expression.as_("rank"),
-			ConstantColumn("Sales Invoice").as_("doctype"),
-			sales_invoice.name.as_("name"),
-			sales_invoice.outstanding_amount.as_("paid_amount"),
-			sales_invoice[reference_field or "name"].as_("reference_no"),
-			sales_invoice.posting_date.as_("reference_date"),
-			sales_invoice.customer.as_("party"),
-			ConstantColumn("Customer").as_("party_type"),
-			sales_invoice.customer_name.as_("party_name"),
-			sales_invoice.posting_date,
-			sales_invoice.currency,
-			party_rank.as_("party_match"),
-			amount_rank.as_("amount_match"),
-			name_match.as_("name_in_desc_match"),
-			(ref_match).as_("ref_in_desc_match"),
-			(ref_rank).as_("reference_number_match"),
-		)
-		.where(sales_invoice.docstatus == 1)
-		.where(sales_invoice.company == company)  # because we do not have bank account check
-		.where(sales_invoice.outstanding_amount != 0.0)
-		.where(sales_invoice.currency == currency)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
-	)
-
-	if include_only_returns:
-		query = query.where(sales_invoice.is_return == 1)
+	# Collected first and added with a single `where`
+	conditions = [
+		invoice.docstatus == 1,
+		amount > 0.0 if spec.company_currency_only else amount != 0.0,
+		*spec.filters(invoice, payment, common_filters, company),
+	]
+	if frappe.flags.auto_reconcile_vouchers and not exact_match:
+		# Only the best matches are used there. The interactive list shows all
+		# candidates, and with an exact match the amount is a signal of every row
+		conditions.append(Criterion.any(signals))
+	if not spec.company_currency_only:
+		conditions.append(invoice.currency == currency)
+	if spec.has_returns and include_only_returns:
+		conditions.append(invoice.is_return == 1)
 	if exact_match:
-		query = query.where(sales_invoice.outstanding_amount == common_filters.amount)
+		conditions.append(amount == common_filters.amount)
 	if common_filters.exact_party_match:
-		query = query.where(party_filter)
+		conditions.append(party_filter)
 
-	return query
+	query = frappe.qb.from_(payment) if payment else frappe.qb.from_(invoice)
+	if payment:
+		query = query.join(invoice).on(payment.parent == invoice.name)
 
+	return (
+		query.select(*columns)
+		.where(Criterion.all(conditions))
+		.orderby(RANK_COLUMN, order=Order.desc)
+		.limit(get_query_limit())
+	)
 
-def get_pi_matching_query(
-	exact_match: bool,
-	currency: str,
-	common_filters: frappe._dict,
-	reference_field: str = "name",
+
+def iter_invoice_functions(
+	document_types: list, is_deposit: bool, currency: str = None, company: str = None
 ):
 	"""
-	Get matching purchase invoice query when they are also used as payment entries (is_paid)
-	"""
-	# Default to bill_no instead of name.
-	# "name" is passed when it is unset. Handle specific default here.
-	if reference_field == "name" or not reference_field:
-		reference_field = "bill_no"
-
-	purchase_invoice = frappe.qb.DocType("Purchase Invoice")
-	description = common_filters.description
+	Yield `(doctype, query function)` for the invoice doctypes to match, in matching order.
 
-	amount_rank = amount_rank_condition(
-		purchase_invoice.paid_amount, common_filters.amount
-	)
-	amount_filter = (
-		(purchase_invoice.paid_amount == common_filters.amount)
-		if exact_match
-		else purchase_invoice.paid_amount != 0.0
+	Lazy, so a caller that only needs one doctype stops before the others. Doctypes
+	that only exist in company currency are left out for other currencies.
+	"""
+	status = "unpaid" if "unpaid_invoices" in document_types else "paid"
+	# Expense claims are never matched against deposits
+	order = (
+		["sales_invoice", "purchase_invoice"]
+		if (is_deposit)
+		else ["purchase_invoice", "expense_claim", "sales_invoice"]
 	)
+	for doctype in order:
+		if doctype not in document_types or not (spec := MATCH_SPECS.get((doctype, status))):
+			continue
+		if spec.company_currency_only and currency != get_company_currency(company):
+			continue
 
-	party_filter = purchase_invoice.supplier == common_filters.party
-	party_rank = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
+		yield doctype, functools.partial(build_invoice_matching_query, spec)
 
-	# date of BT and paid PI could be the same (date of payment or the date of the bill)
-	date_condition = (
-		Coalesce(purchase_invoice.bill_date, purchase_invoice.posting_date)
-		== common_filters.date
-	)
-	date_rank = frappe.qb.terms.Case().when(date_condition, 1).else_(0)
 
-	# Check reference field equality with common_filters.reference_no
-	reference_field_is_set = reference_field and reference_field != "name"
-	reference_number = common_filters.reference_no
-	ref_rank = (
-		ref_equality_condition(purchase_invoice[reference_field], reference_number)
-		if (reference_number and reference_field_is_set)
-		else Cast(0, "int")
-	)
+@frappe.whitelist()
+def import_camt(file, company, bank_account):
+	"""
+	Queue the import of a CAMT file (ZIP or XML) and return the id of its job.
 
-	# if ref field is configured (!= name), perform desc-name and desc-ref match
-	# otherwise (== name), then perform desc-name match once
-	name_match = get_description_match_condition(description, purchase_invoice, "name")
-	ref_match = (
-		get_description_match_condition(description, purchase_invoice, reference_field)
-		if reference_field_is_set
-		else Cast(0, "int")
+	Only the archive's directory is read here, so an unusable upload is reported
+	right away. Parsing and inserting can take minutes on large statements.
+	"""
+	# get_site_path() is relative to the bench's `sites` directory: resolve it once,
+	# so that the job gets absolute paths
+	site_path = os.path.abspath(frappe.utils.get_site_path())
+	xml_file_list = extract_xml_files(file, site_path)
+	if not xml_file_list:
+		frappe.throw(_("No valid XML files found in the provided input."))
+
+	job = frappe.enqueue(
+		"camt_import.camt_import.doctype.transaction_matching_tool.transaction_matching_tool._import_camt_job",
+		queue="long",
+		timeout=1800,
+		xml_file_list=xml_file_list,
+		company=company,
+		bank_account=bank_account,
 	)
+	return {"job_id": job.id if job else None}
 
-	rank_expression = (
-		ref_rank + party_rank + amount_rank + date_rank + name_match + ref_match + 1
-	)
 
-	query = (
-		frappe.qb.from_(purchase_invoice)
-		.select(
-			rank_expression.as_("rank"),
-			ConstantColumn("Purchase Invoice").as_("doctype"),
-			purchase_invoice.name,
-			purchase_invoice.paid_amount,
-			purchase_invoice[reference_field].as_("reference_no"),
-			purchase_invoice.bill_date.as_("reference_date"),
-			purchase_invoice.supplier.as_("party"),
-			ConstantColumn("Supplier").as_("party_type"),
-			purchase_invoice.supplier_name.as_("party_name"),
-			purchase_invoice.posting_date,
-			purchase_invoice.currency,
-			party_rank.as_("party_match"),
-			amount_rank.as_("amount_match"),
-			date_rank.as_("date_match"),
-			name_match.as_("name_in_desc_match"),
-			(ref_match).as_("ref_in_desc_match"),
-			(ref_rank).as_("reference_number_match"),
+def _import_camt_job(xml_file_list, company, bank_account):
+	"""Import the XML files of a CAMT upload and notify the user once it is done."""
+	try:
+		count, skipped = insert_bank_transactions(xml_file_list, company, bank_account)
+	except Exception as e:
+		message = _("Error importing CAMT file: {0}").format(str(e))
+		frappe.msgprint(message, title=_("CAMT Import Failed"), indicator="red", realtime=True)
+		# Not logged here: the background job runner adds the Error Log (with this traceback)
+		frappe.throw(message, exc=CamtImportError)
+
+	frappe.db.commit()
+	message, indicator = _("{0} Bank Transactions imported").format(count), "green"
+	if skipped:
+		message += "<br>" + _("{0} entries were skipped:").format(len(skipped))
+		message += "<ul>{0}</ul>".format(
+			"".join(
+				f"<li>{frappe.bold(booking_date)} {escape_html(reference or '')}: {error}</li>"
+				for booking_date, reference, error in skipped
+			)
 		)
-		.where(purchase_invoice.docstatus == 1)
-		.where(purchase_invoice.is_paid == 1)
-		.where(purchase_invoice.clearance_date.isnull())
-		.where(purchase_invoice.cash_bank_account == common_filters.bank_account)
-		.where(amount_filter)
-		.where(purchase_invoice.currency == currency)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
-	)
-
-	if common_filters.exact_party_match:
-		query = query.where(party_filter)
-
-	return query
+		indicator = "orange"
 
-
-def get_unpaid_pi_matching_query(
-	exact_match: bool,
-	currency: str,
-	common_filters: frappe._dict,
-	company: str,
-	include_only_returns: bool = False,
-	reference_field: str = "name",
-):
-	# Default to bill_no instead of name.
-	# "name" is passed when it is unset. Handle specific default here.
-	if reference_field == "name" or not reference_field:
-		reference_field = "bill_no"
-
-	purchase_invoice = frappe.qb.DocType("Purchase Invoice")
-	description = common_filters.description
-
-	party_filter = purchase_invoice.supplier == common_filters.party
-	party_match = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
-
-	amount_rank = amount_rank_condition(
-		purchase_invoice.outstanding_amount, common_filters.amount
+	frappe.msgprint(message, title=_("CAMT Import Complete"), indicator=indicator, realtime=True)
+	frappe.publish_realtime(
+		"camt_import_complete", {"bank_account": bank_account}, user=frappe.session.user
 	)
 
-	# Check reference field equality with common_filters.reference_no
-	reference_field_is_set = reference_field and reference_field != "name"
-	reference_number = common_filters.reference_no
-	ref_rank = (
-		ref_equality_condition(purchase_invoice[reference_field], reference_number)
-		if (reference_number and reference_field_is_set)
-		else Cast(0, "int")
-	)
 
-	# if ref field is configured (!= name), perform desc-name and desc-ref match
-	# otherwise (== name), then perform desc-name match once
-	name_match = get_description_match_condition(description, purchase_invoice, "name")
-	ref_match = (
-		get_description_match_condition(description, purchase_invoice, reference_field)
-		if reference_field_is_set
-		else Cast(0, "int")
-	)
+def insert_bank_transactions(xml_file_list, company, bank_account) -> tuple[int, list]:
+	"""
+	Insert the XML entries as submitted Bank Transactions.
 
-	rank_expression = ref_rank + party_match + amount_rank + name_match + ref_match + 1
+	Every transaction goes through the controller and its doc events (e.g. party
+	matching). An entry that cannot be inserted is rolled back and skipped, so one
+	bad entry does not abort the whole statement. Returns the number of inserted
+	transactions and the `(booking_date, reference, error)` of the skipped entries.
+	"""
+	gl_account = frappe.db.get_value("Bank Account", bank_account, "account")
+	currency = get_account_currency(gl_account)
+
+	count, skipped = 0, []
+	for booking_date, deposit, withdrawal, reference, description in iter_xml_rows(xml_file_list):
+		frappe.db.savepoint(CAMT_IMPORT_SAVEPOINT)
+		try:
+			frappe.get_doc(
+				{
+					"doctype": "Bank Transaction",
+					"date": booking_date,
+					"company": company,
+					"bank_account": bank_account,
+					"currency": currency,
+					# Currency fields hold floats: a string would reach the doc events as is
+					"deposit": flt(deposit),
+					"withdrawal": flt(withdrawal),
+					"reference_number": reference,
+					"description": description,
+				}
+			).submit()
+		except Exception as e:
+			frappe.db.rollback(save_point=CAMT_IMPORT_SAVEPOINT)
+			skipped.append((booking_date, reference, str(e)))
+			continue
 
-	# We skip date rank as the date of an unpaid bill is mostly
-	# earlier than the date of the bank transaction
-	query = (
-		frappe.qb.from_(purchase_invoice)
-		.select(
-			rank_expression.as_("rank"),
-			ConstantColumn("Purchase Invoice").as_("doctype"),
-			purchase_invoice.name.as_("name"),
-			purchase_invoice.outstanding_amount.as_("paid_amount"),
-			purchase_invoice[reference_field].as_("reference_no"),
-			purchase_invoice.bill_date.as_("reference_date"),
-			purchase_invoice.supplier.as_("party"),
-			ConstantColumn("Supplier").as_("party_type"),
-			purchase_invoice.supplier_name.as_("party_name"),
-			purchase_invoice.posting_date,
-			purchase_invoice.currency,
-			party_match.as_("party_match"),
-			amount_rank.as_("amount_match"),
-			name_match.as_("name_in_desc_match"),
-			ref_match.as_("ref_in_desc_match"),
-			ref_rank.as_("reference_number_match"),
-		)
-		.where(purchase_invoice.docstatus == 1)
-		.where(purchase_invoice.company == company)
-		.where(purchase_invoice.outstanding_amount != 0.0)
-		.where(purchase_invoice.is_paid == 0)
-		.where(purchase_invoice.currency == currency)
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
-	)
+		count += 1
 
-	if include_only_returns:
-		query = query.where(purchase_invoice.is_return == 1)
-	if exact_match:
-		query = query.where(purchase_invoice.outstanding_amount == common_filters.amount)
-	if common_filters.exact_party_match:
-		query = query.where(party_filter)
+	return count, skipped
 
-	return query
 
+def extract_xml_files(file, site_path):
+	"""
+	Collect the XML files of a ZIP or directly add an XML file.
 
-def get_unpaid_ec_matching_query(
-	exact_match: bool,
-	currency: str,
-	common_filters: frappe._dict,
-	company: str,
-	reference_field: str = "name",
-):
-	if currency != get_company_currency(company):
-		# Expense claims are always in company currency
-		return ""
+	Returns the paths of XML files and `(zip_path, member_name)` tuples for ZIP
+	members, which are read straight from the archive instead of being extracted.
+	The paths are absolute if `site_path` is.
+	"""
+	try:
+		xml_file_list = []
+		file_path = site_path + file
+
+		file_extension = os.path.splitext(file)[1].lower()
+
+		if file_extension == '.zip':
+			with zipfile.ZipFile(file_path, 'r') as zip_ref:
+				infos = [info for info in zip_ref.infolist() if is_xml_member(info)]
+				# In on-disk order, so the archive is read sequentially
+				infos.sort(key=lambda info: info.header_offset)
+				xml_file_list = [(file_path, info.filename) for info in infos]
+		elif file_extension == '.xml':
+			xml_file_list.append(file_path)
+		else:
+			frappe.throw(_("Unsupported file format. Please provide a ZIP or XML file."))
 
-	expense_claim = frappe.qb.DocType("Expense Claim")
+		return xml_file_list
+	except Exception as e:
+		frappe.throw(_("Error extracting files: {0}").format(str(e)))
 
-	party_filter = expense_claim.employee == common_filters.party
-	party_match = frappe.qb.terms.Case().when(party_filter, 1).else_(0)
 
-	outstanding_amount = (
-		expense_claim.total_sanctioned_amount
-		+ expense_claim.total_taxes_and_charges
-		- expense_claim.total_amount_reimbursed
-		- expense_claim.total_advance_amount
+def is_xml_member(info: zipfile.ZipInfo) -> bool:
+	"""Check if a ZIP member is an XML file that is safe to read."""
+	name = info.filename
+	return (
+		not info.is_dir()
+		and name.lower().endswith('.xml')
+		# Never trust paths that escape the archive (ZIP slip)
+		and not name.startswith('/')
+		and '..' not in name.split('/')
+		# Skip macOS resource forks (`__MACOSX/._statement.xml`)
+		and not name.startswith('__MACOSX/')
 	)
-	amount_rank = amount_rank_condition(outstanding_amount, common_filters.amount)
 
-	# Check reference field equality with common_filters.reference_no
-	reference_field_is_set = reference_field and reference_field != "name"
-	reference_number = common_filters.reference_no
-	ref_rank = (
-		ref_equality_condition(expense_claim[reference_field], reference_number)
-		if (reference_number and reference_field_is_set)
-		else Cast(0, "int")
-	)
 
-	# if ref field is configured (!= name), perform desc-name and desc-ref match
-	# otherwise (== name), then perform desc-name match once
-	description = common_filters.description
-	name_match = get_description_match_condition(description, expense_claim, "name")
-	ref_match = (
-		get_description_match_condition(description, expense_claim, reference_field)
-		if reference_field_is_set
-		else Cast(0, "int")
-	)
+def iter_xml_rows(xml_file_list):
+	"""
+	Yield the rows of the XML files in file order.
 
-	rank_expression = ref_rank + party_match + amount_rank + name_match + ref_match + 1
+	Parsed one file after another in the job itself: the background worker must
+	not fork a process pool. Every ZIP archive is opened only once, since opening
+	it reads the whole central directory.
+	"""
+	archives = {}
+	try:
+		for xml_file in xml_file_list:
+			if not isinstance(xml_file, tuple):
+				yield from process_xml_stream(xml_file)
+				continue
 
-	query = (
-		frappe.qb.from_(expense_claim)
-		.select(
-			rank_expression.as_("rank"),
-			ConstantColumn("Expense Claim").as_("doctype"),
-			expense_claim.name.as_("name"),
-			outstanding_amount.as_("paid_amount"),
-			expense_claim[reference_field or "name"].as_("reference_no"),
-			expense_claim.posting_date.as_("reference_date"),
-			expense_claim.employee.as_("party"),
-			ConstantColumn("Employee").as_("party_type"),
-			expense_claim.employee_name.as_("party_name"),
-			expense_claim.posting_date,
-			ConstantColumn(currency).as_("currency"),
-			party_match.as_("party_match"),
-			amount_rank.as_("amount_match"),
-			name_match.as_("name_in_desc_match"),
-			ref_match.as_("ref_in_desc_match"),
-			ref_rank.as_("reference_number_match"),
+			zip_path, member_name = xml_file
+			if zip_path not in archives:
+				archives[zip_path] = zipfile.ZipFile(zip_path, 'r')
+			with archives[zip_path].open(member_name) as xml_stream:
+				yield from process_xml_stream(xml_stream)
+	finally:
+		for zip_ref in archives.values():
+			zip_ref.close()
+
+
+def process_xml_stream(xml_source):
+	"""Yield the rows of a CAMT document given as a path or a binary file object."""
+	# Known before parsing: lets lxml match the exact `{uri}Ntry` tag
+	namespace = sniff_namespace(xml_source)
+	xpaths = get_entry_xpaths(namespace) if namespace else None
+	for entry in iter_entries(xml_source, f"{{{namespace}}}Ntry" if namespace else "{*}Ntry"):
+		if xpaths is None:
+			# All entries of a document share its namespace: resolve it once
+			xpaths = get_entry_xpaths(get_namespace(entry))
+
+		# The reference lookup is inlined: it runs for every entry of the statement
+		references = xpaths.creditor_reference(entry)
+		yield make_row(
+			xpaths.booking_date(entry),
+			xpaths.amount(entry),
+			xpaths.credit_debit(entry),
+			(references[0].text or '') if references else xpaths.servicer_reference(entry),
+			xpaths.description(entry),
 		)
-		.where(expense_claim.docstatus == 1)
-		.where(expense_claim.company == company)
-		.where(outstanding_amount > 0.0)
-		.where(expense_claim.status == "Unpaid")
-		.orderby(rank_expression, order=Order.desc)
-		.limit(MAX_QUERY_RESULTS)
-	)
 
-	if exact_match:
-		query = query.where(outstanding_amount == common_filters.amount)
-	if common_filters.exact_party_match:
-		query = query.where(party_filter)
 
-	return query
+def make_row(booking_date, amount, credit_debit, reference, description):
+	"""
+	Build the `(booking_date, deposit, withdrawal, reference, description)` row of an entry.
 
+	The amount is kept as the decimal string of the file; it is converted where
+	the row is inserted (see `insert_bank_transactions`).
+	"""
+	amount = (amount or '').strip() or '0'
+	deposit, withdrawal = (amount, 0) if credit_debit == 'CRDT' else (0, amount)
+	return booking_date, deposit, withdrawal, reference, description or ''
 
-def get_invoice_function_map(document_types: list, is_deposit: bool):
-	"""Get the function map for invoices based on the given filters."""
-	include_unpaid = "unpaid_invoices" in document_types
-	fn_map = {
-		"sales_invoice": (
-			get_unpaid_si_matching_query if include_unpaid else get_si_matching_query
-		),
-		"purchase_invoice": (
-			get_unpaid_pi_matching_query if include_unpaid else get_pi_matching_query
-		),
-		"expense_claim": (
-			get_unpaid_ec_matching_query if (include_unpaid and not is_deposit) else None
-		),
-	}
-	order = (
-		["sales_invoice", "purchase_invoice"]
-		if (is_deposit)
-		else ["purchase_invoice", "expense_claim", "sales_invoice"]
-	)
 
-	# Return the ordered function map that has a function and is in the document types
-	return {
-		doctype: fn_map[doctype]
-		for doctype in order
-		if (doctype in document_types and fn_map[doctype])
-	}
+def sniff_namespace(xml_source) -> str:
+	"""
+	Read the CAMT namespace from the first bytes of a document, without parsing it.
 
+	Returns an empty string if it is not declared there (or the stream cannot be peeked).
+	"""
+	if isinstance(xml_source, str):
+		with open(xml_source, "rb") as xml_file:
+			head = xml_file.read(NAMESPACE_SNIFF_SIZE)
+	elif peek := getattr(xml_source, "peek", None):
+		# Does not consume the stream (ZIP members buffer up to 512 bytes)
+		head = peek(NAMESPACE_SNIFF_SIZE)[:NAMESPACE_SNIFF_SIZE]
+	else:
+		return ""
 
-@frappe.whitelist()
-def import_camt(file, company, bank_account):
-	try:
-		xml_file_list = extract_xml_files(file)
-		if not xml_file_list:
-			frappe.throw(_("No valid XML files found in the provided input."))
+	match = CAMT_NAMESPACE_PATTERN.search(head)
+	return match.group(1).decode() if match else ""
 
-		csv_file_doc = parse_xml_to_csv(xml_file_list, company, bank_account)
-		bank_statement_import = create_new_bank_statement_import(
-			csv_file_doc, company, bank_account
-		)
-		bank_statement_import.start_import()
-	except Exception as e:
-		frappe.log_error(frappe.get_traceback(), _("CAMT Import Error"))
-		frappe.throw(_("Error importing CAMT file: {0}").format(str(e)))
 
+def iter_entries(xml_source, tag="{*}Ntry"):
+	"""
+	Stream the `Ntry` elements of a CAMT file.
 
-def extract_xml_files(file):
-	"""Extract XML files from a ZIP or directly add an XML file."""
-	try:
-		xml_file_list = []
-		file_path = '/private/files/temp_camt_zip_extracted/'
-
-		if file.endswith('.zip'):
-			zip_folder_path = frappe.get_site_path() + file_path
-			with zipfile.ZipFile(frappe.get_site_path() + file, 'r') as zip_ref:
-				zip_ref.extractall(zip_folder_path)
-				extracted_files = os.listdir(zip_folder_path)
-
-				# Adjust file path if there's a folder matching the ZIP name
-				file_name = file.split('/')[-1].replace('.zip', '')
-				if file_name in extracted_files:
-					file_path += file_name + '/'
-
-				# Collect XML files
-				xml_file_list = [
-					f"{file_path}{filename}"
-					for filename in os.listdir(frappe.get_site_path() + file_path)
-					if filename.endswith('.xml')
-				]
-		elif file.endswith('.xml'):
-			xml_file_list.append(file)
-		else:
-			frappe.throw(_("Unsupported file format. Please provide a ZIP or XML file."))
+	Each entry is released as soon as the consumer is done with it, so memory
+	stays bounded by a single entry instead of the whole document.
+	"""
+	# iterparse builds its own parser and takes the parser options as keywords
+	context = etree.iterparse(xml_source, events=("end",), tag=tag, **LXML_PARSER_OPTIONS)
+	for _event, entry in context:
+		yield entry
 
-		return xml_file_list
-	except Exception as e:
-		frappe.throw(_("Error extracting files: {0}").format(str(e)))
+		entry.clear()
+		while entry.getprevious() is not None:
+			del entry.getparent()[0]
 
 
-def parse_xml_to_csv(xml_file_list, company, bank_account):
-	"""Parse XML files to generate a CSV document."""
-	try:
-		timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-		site_path = frappe.utils.get_site_path()
-		csv_file_path = os.path.join(site_path, "private", "files", f"camt-{timestamp}.csv")
+@functools.lru_cache(maxsize=None)
+def get_entry_xpaths(namespace: str) -> frappe._dict:
+	"""
+	Compile the XPath expressions for the `Ntry` fields of a namespace once.
 
-		write_csv_from_xml(xml_file_list, csv_file_path, company, bank_account)
+	Compiled expressions are evaluated by libxml2 itself, while `find` and
+	`findtext` go through lxml's ElementPath implementation in Python.
+	"""
+	namespaces = {"ns": namespace} if namespace else None
+	prefix = "ns:" if namespace else ""
 
-		return create_csv_file_doc(csv_file_path, timestamp)
-	except Exception as e:
-		frappe.throw(_("Error parsing XML: {0}").format(str(e)))
+	def compile_xpath(path):
+		# Plain strings: smart strings keep the entry alive
+		return etree.XPath(
+			path.replace("ns:", prefix), namespaces=namespaces, smart_strings=False
+		)
 
+	return frappe._dict(
+		booking_date=compile_xpath("string(ns:BookgDt/ns:Dt)"),
+		amount=compile_xpath("string(ns:Amt)"),
+		credit_debit=compile_xpath("string(ns:CdtDbtInd)"),
+		creditor_reference=compile_xpath(".//ns:CdtrRefInf/ns:Ref"),
+		servicer_reference=compile_xpath("string((.//ns:AcctSvcrRef)[1])"),
+		description=compile_xpath("string(ns:AddtlNtryInf)"),
+	)
 
-def write_csv_from_xml(xml_file_list, csv_file_path, company, bank_account):
-	"""Write entries from XML files into a CSV."""
-	header = ['Date', 'Company', 'Bank Account', 'Deposit', 'Withdrawal', 'Reference Number', 'Description']
-	with open(csv_file_path, 'w', newline='') as csvfile:
-		writer = csv.writer(csvfile)
-		writer.writerow(header)
 
-		for xml_file in xml_file_list:
-			process_xml_file(writer, xml_file, company, bank_account)
-
-
-def process_xml_file(writer, xml_file, company, bank_account):
-	"""Process a single XML file and write entries to CSV."""
-	site_path = frappe.utils.get_site_path()
-	xml_file_path = os.path.join(site_path, xml_file.lstrip('/'))
-	tree = ET.parse(xml_file_path)
-	root = tree.getroot()
-
-	namespace = {'ns': get_namespace(root)}
-	entries = root.findall('.//ns:Ntry', namespace)
-
-	for entry in entries:
-		booking_date = entry.find('./ns:BookgDt/ns:Dt', namespace).text
-		amount = float(entry.find('./ns:Amt', namespace).text or '0')
-		is_credit = entry.find('./ns:CdtDbtInd', namespace).text == 'CRDT'
-		deposit, withdrawal = (amount, 0) if is_credit else (0, amount)
-		reference = get_reference(entry, namespace)
-		description = entry.find('./ns:AddtlNtryInf', namespace).text or ''
-
-		writer.writerow([booking_date, company, bank_account, deposit, withdrawal, reference, description])
-
-
-def get_reference(entry, namespace):
-	"""Extract reference from XML entry."""
-	reference = entry.find('.//ns:CdtrRefInf/ns:Ref', namespace)
-	if reference is not None:
-		return reference.text
-	acct_svcr_ref = entry.find('.//ns:AcctSvcrRef', namespace)
-	return acct_svcr_ref.text if acct_svcr_ref is not None else ''
-
-
-def create_csv_file_doc(csv_file_path, timestamp):
-	"""Create and insert a File document for the CSV."""
-	file_doc = frappe.get_doc({
-		"doctype": "File",
-		"file_name": f"camt-{timestamp}.csv",
-		"file_path": csv_file_path,
-		"file_url": f"/private/files/camt-{timestamp}.csv",
-		"is_private": 1
-	})
-	file_doc.insert(ignore_permissions=True)
-	return file_doc
-
-
-def create_new_bank_statement_import(csv_file_doc, company, bank_account):
-	"""Create a Bank Statement Import document."""
-	try:
-		bank_statement_import = frappe.new_doc("Bank Statement Import")
-		bank_statement_import.company = company
-		bank_statement_import.bank_account = bank_account
-		bank_statement_import.import_file = csv_file_doc.file_url
-		bank_statement_import.reference_doctype = "Bank Transaction"
-		bank_statement_import.import_type = "Insert New Records"
-		bank_statement_import.template_options = '{"column_to_field_map": {}}'
-		bank_statement_import.insert(ignore_permissions=True)
-		return bank_statement_import
-	except Exception as e:
-		frappe.throw(_("Error creating Bank Statement Import: {0}").format(str(e)))
+# Pre-compile the expressions of the namespaces banks commonly deliver
+for _namespace in CAMT_NAMESPACES:
+	get_entry_xpaths(_namespace)
 
 
 def get_namespace(element):
@@ -1,12 +1,16 @@
+import functools
+import re
+
 import frappe
 from frappe import _
 
 from pypika.queries import Table
 from pypika.terms import Case, Field
-from frappe.query_builder.functions import CustomFunction, Cast
+from frappe.query_builder.functions import CustomFunction, Cast, Trim
 
 Instr = CustomFunction("INSTR", ["a", "b"])
 RegExpReplace = CustomFunction("REGEXP_REPLACE", ["a", "b", "c"])
+DIGIT_PATTERN = re.compile(r"[0-9]")
 
 # NOTE:
 # Ranking min: 1 (nothing matches), max: 7 (everything matches)
@@ -25,15 +29,21 @@ def amount_rank_condition(amount: Field, bank_amount: float) -> Case:
 	return frappe.qb.terms.Case().when(amount == bank_amount, 1).else_(0)
 
 
+def is_reference_provided(bank_reference_no: str) -> bool:
+	"""Check if the bank statement carries a usable reference number."""
+	return bool(bank_reference_no) and bank_reference_no != "NOTPROVIDED"
+
+
 def ref_equality_condition(reference_no: Field, bank_reference_no: str) -> Case:
 	"""Get the rank query for reference number matching."""
-	if not bank_reference_no or bank_reference_no == "NOTPROVIDED":
+	if not is_reference_provided(bank_reference_no):
 		# If bank reference number is not provided, then it is not a match
 		return Cast(0, "int")
 
 	return frappe.qb.terms.Case().when(reference_no == bank_reference_no, 1).else_(0)
 
 
+@functools.lru_cache(maxsize=256)
 def get_description_match_condition(
 	description: str, table: Table, column_name: str = "name"
 ) -> Case:
@@ -45,29 +55,40 @@ def get_description_match_condition(
 
 	Returns:
 	A query condition that will be 1 if the description contains the document number
-	and 0 otherwise.
+	and 0 otherwise. Conditions are cached, callers must not mutate them.
+
+	The match is case-sensitive: INSTR would follow the case-insensitive collation
+	of the column, so the description is compared as binary.
 	"""
 	if not description:
 		return Cast(0, "int")
 
 	column_name = column_name or "name"
 	column = table[column_name]
+	haystack = Cast(description, "BINARY")
 	# Perform replace if the column is the name, else the column value is ambiguous
 	# Eg. column_name = "custom_ref_no" and its value = "tuf5673i" should be untouched
 	if column_name == "name":
+		if not DIGIT_PATTERN.search(description):
+			# The number part of a name starts with a digit: it cannot occur in the
+			# description, so skip the per-row REGEXP_REPLACE
+			return Cast(0, "int")
+
 		return (
 			frappe.qb.terms.Case()
 			.when(
-				Instr(description, RegExpReplace(column, r"^[^0-9]*", "")) > 0,
+				Instr(haystack, RegExpReplace(column, r"^[^0-9]*", "")) > 0,
 				1,
 			)
 			.else_(0)
 		)
 	else:
+		# References are often entered with stray whitespace
+		reference = Trim(column)
 		return (
 			frappe.qb.terms.Case()
 			.when(
-				column.notnull() & (column != "") & (Instr(description, column) > 0),
+				column.notnull() & (reference != "") & (Instr(haystack, reference) > 0),
 				1,
 			)
 			.else_(0)
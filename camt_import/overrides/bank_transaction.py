@@ -34,6 +34,9 @@ class CustomBankTransaction(BankTransaction):
 			self.reconcile_paid_vouchers(vouchers)
 
 		if len(self.payment_entries) != pe_length_before:
+			if frappe.flags.skip_bank_transaction_recompute:
+				# The caller allocates the new entries and saves once afterwards
+				return
 			self.save()  # runs on_update_after_submit
 
 	def validate_period_closing(self):
@@ -140,7 +143,7 @@ class CustomBankTransaction(BankTransaction):
 					"debit_in_account_currency": row.allocated_amount if self.withdrawal > 0 else 0.0,
 					"party_type": row.get("party_type"),
 					"party": row.get("party"),
-					"cost_center": get_default_cost_center(company),
+					"cost_center": cost_center,
 					"reference_type": row.voucher_type,
 					"reference_name": row.voucher_no,
 				},
@@ -152,6 +155,7 @@ class CustomBankTransaction(BankTransaction):
 		company, company_currency = frappe.get_value(
 			"Account", company_account, ["company", "account_currency"]
 		)
+		cost_center = get_default_cost_center(company)
 
 		journal_entry = frappe.new_doc("Journal Entry")
 		journal_entry.voucher_type = "Bank Entry"
@@ -176,7 +180,7 @@ class CustomBankTransaction(BankTransaction):
 					total_allocated_amount if self.withdrawal > 0 else 0.0
 				),
 				"debit_in_account_currency": total_allocated_amount if self.deposit > 0 else 0.0,
-				"cost_center": get_default_cost_center(company),
+				"cost_center": cost_center,
 			},
 		)
 
@@ -0,0 +1,20 @@
+import frappe
+
+
+def execute():
+	# Unpaid invoices of a company, see `MATCH_SPECS`
+	# Index names are per table: on Postgres they must be unique within the schema
+	for doctype in ("Sales Invoice", "Purchase Invoice"):
+		frappe.db.add_index(
+			doctype,
+			["company", "docstatus", "currency", "outstanding_amount"],
+			index_name=f"{frappe.scrub(doctype)}_tmt_match_idx",
+		)
+
+	# Expense Claim is part of HRMS, which is optional
+	if frappe.db.table_exists("Expense Claim"):
+		frappe.db.add_index(
+			"Expense Claim",
+			["company", "status", "docstatus"],
+			index_name="expense_claim_tmt_match_idx",
+		)
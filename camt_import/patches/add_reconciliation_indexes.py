@@ -0,0 +1,18 @@
+import frappe
+
+
+def execute():
+	# Unreconciled transactions of a bank account, ordered by date
+	frappe.db.add_index(
+		"Bank Transaction",
+		["bank_account", "docstatus", "date", "unallocated_amount"],
+		index_name="bt_recon_idx",
+	)
+
+	# Uncleared payments of a bank account, see `get_pe_matching_query`
+	for account_field in ("paid_from", "paid_to"):
+		frappe.db.add_index(
+			"Payment Entry",
+			["clearance_date", account_field],
+			index_name=f"pe_clearance_{account_field}_idx",
+		)